@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+
+### Summarise replay profiles written with --profile or USECASE_REPLAY_PROFILE
+
+import os, sys
+
+install_root = os.path.dirname(os.path.dirname(os.path.normpath(os.path.realpath(os.path.abspath(sys.argv[0])))))
+# Find our own "lib" directory
+sys.path.insert(0, os.path.join(install_root, "lib"))
+
+binDir = os.path.normpath(os.path.dirname(__file__))
+if binDir in sys.path:
+   sys.path.remove(binDir)
+
+if __name__ == "__main__":    
+    from storytext.profiler import main
+    main()
@@ -25,6 +25,10 @@ For fuller documentation refer to the online docs at http://www.texttest.org"""
                       help="amount of time to wait between each action when replaying. Also enabled via the environment variable USECASE_REPLAY_DELAY.")
     
     default_interface = "gtk" if sys.version_info[0] == 2 else "tkinter"
+    parser.add_option("--describe-rows", metavar="ROWS", type="int",
+                      help="describe at most ROWS rows of each table or tree in the auto-generated output. The first and last rows are described along with those scrolled into view, the others are summarised with a hash of their contents. Can be set for individual widgets with a 'DescribeRows' entry in their UI map section. Also set via the environment variable STORYTEXT_DESCRIBE_ROWS.")
+    parser.add_option("--dirty-tracking", metavar="MODE", type="choice", choices=[ "on", "verify" ],
+                      help="(SWT/Eclipse only) after each action, only check for state changes in widgets the toolkit has reported as painted, resized, shown, hidden, modified or selected since the last check, rather than in every widget described. With MODE 'verify' every widget is still checked, and any change that would have been missed is reported on standard error. Also enabled via the environment variable STORYTEXT_DIRTY_TRACKING.")
     parser.add_option("-i", "--interface", metavar="INTERFACE",
                       help="type of interface used by application, should be 'console', 'gtk', gtk3, 'tkinter', 'wx', 'javaswing', 'javaswt', 'javarcp' or 'javagef' ('" + default_interface + "' is default)", 
                       default=default_interface)
@@ -42,6 +46,12 @@ For fuller documentation refer to the online docs at http://www.texttest.org"""
                       help="Configure StoryText logging via the log configuration file at FILE. A suitable sample file can be find with the source tree under the 'log' directory.", metavar="FILE")
     parser.add_option("-m", "--mapfiles", default=os.path.join(scriptengine.ScriptEngine.storytextHome, "ui_map.conf"),
                       help="Use the UI map file(s) at FILE1,... If not set StoryText will read and write such a file at the location determined by $STORYTEXT_HOME/ui_map.conf. If run standalone $STORYTEXT_HOME defaults to ~/.storytext, while TextTest will point it to a 'storytext_files' subdirectory of the root test suite. If multiple files are provided, the last in the list will be used for writing.", metavar="FILE1,...")
+    parser.add_option("--mapfile-cache", action="store_true",
+                      help="Store the parsed contents of each UI map file in a file alongside it with the suffix '.cache', and read that instead of the UI map file while it is up to date. Speeds up startup with large UI map files. Also enabled via the environment variable STORYTEXT_MAP_CACHE.")
+    parser.add_option("--mapfile-write-delay", metavar="SECONDS",
+                      help="Don't rewrite the UI map file as soon as it changes, but once no further changes have been made for SECONDS, or on exit. Unwritten changes are kept in a journal file alongside it, one per process, and recovered by the next process on the same machine if the process dies. The file is then replaced rather than rewritten, so it is never seen half-written. Also enabled via the environment variable STORYTEXT_MAP_WRITE_DELAY, which the editor also reads.")
+    parser.add_option("--mutual-synch", metavar="PROTOCOL", type="choice", choices=[ "files", "socket" ],
+                      help="How to synchronise with other processes waiting for 'other usecase' events. With 'files' (the default), files are created and polled for in the current directory. With 'socket', a Unix domain socket is used, keyed on the current directory or on the environment variable STORYTEXT_MUTUAL_SYNCH_KEY if set. This is not available in Jython. All processes synchronising with each other must use the same protocol. With sockets, 'other usecase <name> (N processes)' synchronises N processes rather than 2. Also set via the environment variable STORYTEXT_MUTUAL_SYNCH.")
     parser.add_option("-M", "--maxoutputwidth",
                       help="maximum output width for side-by-side output in the auto-generated output")
     parser.add_option("-p", "--replay", 
@@ -52,8 +62,14 @@ For fuller documentation refer to the online docs at http://www.texttest.org"""
                       help="record script to FILE. Also enabled via the environment variable USECASE_RECORD_SCRIPT.", metavar="FILE")
     parser.add_option("-s", "--supported", action="store_true",
                       help="list which PyGTK widgets and signals are currently supported 'out-of-the-box'")
+    parser.add_option("--profile", metavar="FILE",
+                      help="write the time taken by each stage of replaying each command to FILE, one JSON object per line. Summarise with bin/storytext_profile_summary.py. Also enabled via the environment variable USECASE_REPLAY_PROFILE.")
     parser.add_option("-S", "--screenshot", action="store_true",
                       help="Take screenshots of the GUI after each action. Only works in SWT/Eclipse currently. Also enabled via the environment variable USECASE_REPLAY_SCREENSHOTS.")
+    parser.add_option("--treeview-diffs", action="store_true",
+                      help="(PyGTK only) when a tree view's model is updated, describe only the rows inserted, changed or removed rather than the whole tree view. It is still described in full when shown, expanded, collapsed, sorted or when its selection changes. Also enabled via the environment variable STORYTEXT_TREEVIEW_DIFFS.")
+    parser.add_option("--turbo", action="store_true",
+                      help="replay as fast as possible: where StoryText can tell when the application is idle, wait for that instead of sleeping for fixed times, and retry finding widgets quickly at first. Any delay given by -d is ignored. Also enabled via the environment variable USECASE_REPLAY_TURBO.")
     parser.add_option("-t", "--timeout", metavar="SECONDS", default=60, action="store", type="int",
                       help="amount of time to wait for application events before giving up and trying to proceed.")
     parser.add_option("-T", "--testscriptpluginid",
@@ -116,6 +132,22 @@ def set_up_environment(options):
         os.environ["USECASE_REPLAY_DELAY"] = max(os.getenv("USECASE_REPLAY_DELAY"), options.delay)
     if options.screenshot:
         os.environ["USECASE_REPLAY_SCREENSHOTS"] = "1"
+    if options.profile:
+        os.environ["USECASE_REPLAY_PROFILE"] = os.path.abspath(options.profile)
+    if options.treeview_diffs:
+        os.environ["STORYTEXT_TREEVIEW_DIFFS"] = "1"
+    if options.turbo:
+        os.environ["USECASE_REPLAY_TURBO"] = "1"
+    if options.describe_rows:
+        os.environ["STORYTEXT_DESCRIBE_ROWS"] = str(options.describe_rows)
+    if options.dirty_tracking:
+        os.environ["STORYTEXT_DIRTY_TRACKING"] = options.dirty_tracking
+    if options.mapfile_cache:
+        os.environ["STORYTEXT_MAP_CACHE"] = "1"
+    if options.mapfile_write_delay:
+        os.environ["STORYTEXT_MAP_WRITE_DELAY"] = options.mapfile_write_delay
+    if options.mutual_synch:
+        os.environ["STORYTEXT_MUTUAL_SYNCH"] = options.mutual_synch
 
 
 def check_python_version():
@@ -72,6 +72,7 @@ class UseCaseEditor:
         self.isAutoGenerated = len(autoGenerated) > 0
         dialog = self.createDialog(autoGeneratedInfo, commands)
         self.runDialog(dialog, autoGenerated, autoGeneratedInfo)
+        self.uiMapFileHandler.flush()
 
     def runDialog(self, dialog, autoGenerated, autoGeneratedInfo):
         response = dialog.run()
@@ -640,6 +641,7 @@ class UseCaseEditor:
                     childIter = self.treeModel.iter_next(childIter)
             else:
                 recordScript.record(value)
+        recordScript.close()
 
     def respond(self, dialog, responseId, entry, frame, shortcutView):
         if responseId == gtk.RESPONSE_ACCEPT:
@@ -664,6 +666,7 @@ class UseCaseEditor:
                 self.runShortcutCommands(recordScript, shortcut, args)
             else:
                 recordScript.record(value)
+        recordScript.close()
 
     def runShortcutCommands(self, recordScript, shortcut, args):
         shortcutCopy = ReplayScript(shortcut.name, True)
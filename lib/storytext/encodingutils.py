@@ -34,14 +34,26 @@ def getLocaleEncoding():
     return localeEncoding
     
 class EncodingLoggerProxy:
+    # Arguments are only formatted, and text only encoded, if the level is enabled.
+    # Text that is already encoded (str in Python 2) is written as it is.
     def __init__(self, logger):
         self.logger = logger
         
-    def info(self, msg):
-        self.logger.info(encodeToLocale(msg))
+    def info(self, msg, *args):
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info(self.encode(msg, args))
 
-    def debug(self, msg):
-        self.logger.debug(encodeToLocale(msg))
+    def debug(self, msg, *args):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(self.encode(msg, args))
+
+    def encode(self, msg, args):
+        if args:
+            msg = msg % args
+        if isinstance(msg, str):
+            return msg
+        else:
+            return encodeToLocale(msg)
         
     def __getattr__(self, name):
         return getattr(self.logger, name)
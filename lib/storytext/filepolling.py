@@ -1,16 +1,151 @@
 
-from threading import Thread
-import os, time
+from threading import Thread, Lock, currentThread
+from traceback import format_exception
+import os, sys, time
+
+try:
+    import ctypes, ctypes.util, select
+except ImportError: # e.g. Jython
+    ctypes = None
+
+class Inotify:
+    # Directory changes that can make a file appear or disappear
+    mask = 0x40 | 0x80 | 0x100 | 0x200 # IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError, "inotify_init failed"
+        self.dirWatches = {}
+
+    def addDir(self, dirName):
+        if dirName not in self.dirWatches:
+            if isinstance(dirName, unicode):
+                wd = self.libc.inotify_add_watch(self.fd, dirName.encode(sys.getfilesystemencoding()), self.mask)
+            else:
+                wd = self.libc.inotify_add_watch(self.fd, dirName, self.mask)
+            if wd >= 0:
+                self.dirWatches[dirName] = wd
+
+    def removeDir(self, dirName):
+        wd = self.dirWatches.pop(dirName, None)
+        if wd is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def wait(self, timeout):
+        if select.select([ self.fd ], [], [], timeout)[0]:
+            # Don't care what happened, all watched files get checked anyway
+            os.read(self.fd, 65536)
+
+
+def makeInotify():
+    if ctypes is not None and sys.platform.startswith("linux"):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+            return Inotify(libc)
+        except (OSError, AttributeError):
+            pass
+
+
+class FileWatch:
+    def __init__(self, watcher, fileName, eventName, appEventMethod):
+        self.watcher = watcher
+        self.fileName = fileName
+        self.dirName = os.path.dirname(os.path.abspath(fileName))
+        self.eventName = eventName
+        self.appEventMethod = appEventMethod
+        self.startState = os.path.exists(fileName)
+
+    def hasChanged(self):
+        return os.path.exists(self.fileName) != self.startState
+
+    def notify(self):
+        self.appEventMethod(self.eventName, category="file poll")
+
+    def cancel(self):
+        self.watcher.remove(self)
+
+
+class FileWatcher:
+    # Checks all watched files from a single thread, which only runs while there is something to watch.
+    # With inotify we wake up as soon as a watched directory changes, and only poll in case it misses
+    # something (e.g. changes made on another machine over NFS).
+    # Otherwise we poll, starting quickly and slowing down while nothing happens.
+    minInterval = 0.005
+    maxInterval = 0.1
+    def __init__(self):
+        self.lock = Lock()
+        self.watches = []
+        self.thread = None
+        self.inotify = makeInotify()
+        self.interval = self.minInterval
+
+    def add(self, watch):
+        self.lock.acquire()
+        self.watches.append(watch)
+        if self.inotify:
+            self.inotify.addDir(watch.dirName)
+        self.interval = self.minInterval
+        if self.thread is None:
+            self.thread = Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        self.lock.release()
+
+    def remove(self, watch):
+        self.lock.acquire()
+        if watch in self.watches:
+            self.removeWatch(watch)
+        self.lock.release()
+
+    def removeWatch(self, watch):
+        self.watches.remove(watch)
+        if self.inotify and not any((w.dirName == watch.dirName for w in self.watches)):
+            self.inotify.removeDir(watch.dirName)
+
+    def run(self):
+        try:
+            self.watchFiles()
+        finally:
+            # If something went wrong, make sure the next watch added starts a new thread
+            self.lock.acquire()
+            if self.thread is currentThread():
+                self.thread = None
+            self.lock.release()
+
+    def watchFiles(self):
+        while True:
+            self.lock.acquire()
+            changed = [ watch for watch in self.watches if watch.hasChanged() ]
+            for watch in changed:
+                self.removeWatch(watch)
+            finished = len(self.watches) == 0
+            if finished:
+                self.thread = None
+            elif not changed:
+                self.interval = min(self.interval * 2, self.maxInterval)
+            interval = self.interval
+            self.lock.release()
+            for watch in changed:
+                try:
+                    watch.notify()
+                except:
+                    # Don't let one watch stop the others
+                    sys.stderr.write("".join(format_exception(*sys.exc_info())))
+            if finished:
+                return
+            elif self.inotify:
+                self.inotify.wait(self.maxInterval)
+            else:
+                time.sleep(interval)
+
+watcher = None
 
 def poll_file(fileName, eventName, appEventMethod):
+    global watcher
+    if watcher is None:
+        watcher = FileWatcher()
     eventName = eventName or fileName + " to be updated"
-    startState = os.path.exists(fileName)
-    class PollThread(Thread):
-        def run(self):
-            while os.path.exists(fileName) == startState:
-                time.sleep(0.1)
-            appEventMethod(eventName, category="file poll")
-            
-    thread = PollThread()
-    thread.setDaemon(True)
-    thread.start()
+    watch = FileWatch(watcher, fileName, eventName, appEventMethod)
+    watcher.add(watch)
+    return watch
@@ -10,7 +10,8 @@ class GridFormatter:
         self.allowOverlap = allowOverlap
 
     def __str__(self):
-        colWidths = self.findColumnWidths()
+        cellLines = self.getCellLines()
+        colWidths = self.findColumnWidths(cellLines)
         totalWidth = sum(colWidths)
         if self.maxWidth is not None and len(self.grid) == 1 and totalWidth > self.maxWidth: 
             # After a while, excessively wide grids just get too hard to read
@@ -20,75 +21,98 @@ class GridFormatter:
             footer = "." * len(header)
             return header + "\n" + desc + "\n" + footer
         else:
-            return self.formatCellsInGrid(colWidths)
+            return self.formatCellsInGrid(colWidths, cellLines)
 
     def isHorizontalRow(self):
         return len(self.grid) == 1 and self.numColumns > 1
 
-    def findColumnWidths(self):
+    def getCellLines(self):
+        # Not kept, the grid can be changed after the column widths are found
+        return [ [ cellText.splitlines() for cellText in row ] for row in self.grid ]
+
+    def findColumnWidths(self, cellLines=None):
+        if cellLines is None:
+            cellLines = self.getCellLines()
+        # Widths of the cells in each column, and which of them might overlap empty cells to their right
+        columnCellWidths = [ [ 0 ] * len(self.grid) for _ in range(self.numColumns) ]
+        overlapRows = [ [] for _ in range(self.numColumns) ]
+        for rowIx, (row, rowCellLines) in enumerate(zip(self.grid, cellLines)):
+            lastColNum = len(row) - 1
+            for colNum, lines in enumerate(rowCellLines[:self.numColumns]):
+                if lines:
+                    width = max(map(len, lines))
+                    if width > 0:
+                        if colNum != lastColNum:
+                            width += self.columnSpacing
+                        if self.allowOverlap and colNum + 1 < self.numColumns and \
+                               (colNum == lastColNum or len(row[colNum + 1]) == 0):
+                            overlapRows[colNum].append(rowIx)
+                    columnCellWidths[colNum][rowIx] = width
+
         colWidths = [ 0 ] * self.numColumns
         for colNum in reversed(range(self.numColumns)):
-            cellWidths = set((self.getCellWidth(rowIx, row, colNum, colWidths) for rowIx, row in enumerate(self.grid)))
+            cellWidths = columnCellWidths[colNum]
+            for rowIx in overlapRows[colNum]:
+                cellWidths[rowIx] = self.getOverlapWidth(rowIx, self.grid[rowIx], colNum, cellWidths[rowIx], colWidths)
             maxWidth = max(cellWidths) or -min(cellWidths)
             colWidths[colNum] = maxWidth
         return colWidths
 
-    def getCellWidth(self, rowIx, row, colNum, colWidths):
-        if colNum < len(row):
-            cellText = row[colNum]
-            lines = cellText.splitlines()
-            if lines:
-                realMaxWidth = max((len(line) for line in lines))
-                if colNum != len(row) - 1 and realMaxWidth > 0:
-                    realMaxWidth += self.columnSpacing
-                if not self.allowOverlap or not self.allowOverlapInCell(rowIx, colNum, cellText):
-                    return realMaxWidth
-                
-                c = colNum + 1
-                maxWidth = realMaxWidth
-                # If the following columns are empty, assume we can overlap them
-                while maxWidth > 0 and c < self.numColumns and (c >= len(row) or len(row[c]) == 0):
-                    maxWidth -= colWidths[c]
-                    c += 1
-                maxWidth = max(maxWidth, 0)
-                if realMaxWidth and not maxWidth:
-                    return -realMaxWidth # our way of saying 'use this if there is nothing else in this column'
-                else:
-                    return maxWidth
-        return 0
+    def getOverlapWidth(self, rowIx, row, colNum, realMaxWidth, colWidths):
+        if not self.allowOverlapInCell(rowIx, colNum, row[colNum]):
+            return realMaxWidth
+
+        c = colNum + 1
+        maxWidth = realMaxWidth
+        # If the following columns are empty, assume we can overlap them
+        while maxWidth > 0 and c < self.numColumns and (c >= len(row) or len(row[c]) == 0):
+            maxWidth -= colWidths[c]
+            c += 1
+        maxWidth = max(maxWidth, 0)
+        if not maxWidth:
+            return -realMaxWidth # our way of saying 'use this if there is nothing else in this column'
+        else:
+            return maxWidth
 
     def allowOverlapInCell(self, row, colNum, cellText):
         # Hook for derived classes to allow overlapping in some grid regions and not others
         return True
 
     def formatColumnsInGrid(self):
-        desc = ""
+        parts = []
         for colNum in range(self.numColumns):
             for row in self.grid:
                 if colNum < len(row):
-                    desc += row[colNum] + "\n"
-            desc += "\n"
-        return desc.rstrip()
+                    parts.append(row[colNum] + "\n")
+            parts.append("\n")
+        return "".join(parts).rstrip()
 
-    def formatCellsInGrid(self, colWidths):
+    def formatCellsInGrid(self, colWidths, cellLines=None):
+        if cellLines is None:
+            cellLines = self.getCellLines()
         lines = []
-        for row in self.grid:
-            rowLines = max((desc.count("\n") + 1 for desc in row))
+        for row, rowCellLines in zip(self.grid, cellLines):
+            rowLines = max([ desc.count("\n") + 1 for desc in row ])
+            rowWidths = colWidths[:len(row)]
+            # While every cell fits its column, each line is just the padded cells joined together
+            rowWidth = sum(rowWidths) if len(rowWidths) == len(row) and min(rowWidths or [ 0 ]) >= 0 else None
             for rowLine in range(rowLines):
-                lineText = ""
-                currPos = 0
-                for colNum, childDesc in enumerate(row):
-                    cellLines = childDesc.splitlines()
-                    if rowLine < len(cellLines):
-                        cellRow = cellLines[rowLine]
-                    else:
-                        cellRow = ""
-                    if cellRow and len(lineText) > currPos:
-                        lineText = lineText[:currPos]
-                    lineText += cellRow.ljust(colWidths[colNum])
-                    currPos += colWidths[colNum]
+                cellRows = [ textLines[rowLine] if rowLine < len(textLines) else "" for textLines in rowCellLines ]
+                lineText = "".join([ cellRow.ljust(width) for cellRow, width in zip(cellRows, rowWidths) ])
+                if len(lineText) != rowWidth:
+                    lineText = self.formatOverlappingCells(cellRows, colWidths)
                 lines.append(lineText.rstrip(" ")) # don't leave trailing spaces
         return "\n".join(lines)
+
+    def formatOverlappingCells(self, cellRows, colWidths):
+        lineText = ""
+        currPos = 0
+        for colNum, cellRow in enumerate(cellRows):
+            if cellRow and len(lineText) > currPos:
+                lineText = lineText[:currPos]
+            lineText += cellRow.ljust(colWidths[colNum])
+            currPos += colWidths[colNum]
+        return lineText
     
 class GridFormatterWithHeader:
     def __init__(self, headerRows, rows, columnCount, minWidths={}):
@@ -98,10 +122,15 @@ class GridFormatterWithHeader:
         self.minFieldWidths = minWidths
 
     def __str__(self):
-        colWidths = GridFormatter(self.headerRows + self.rows, self.columnCount, allowOverlap=False).findColumnWidths()
+        headerFormatter = GridFormatter(self.headerRows, self.columnCount)
+        bodyFormatter = GridFormatter(self.rows, self.columnCount)
+        headerCellLines = headerFormatter.getCellLines()
+        bodyCellLines = bodyFormatter.getCellLines()
+        allFormatter = GridFormatter(self.headerRows + self.rows, self.columnCount, allowOverlap=False)
+        colWidths = allFormatter.findColumnWidths(headerCellLines + bodyCellLines)
         self.adjustForMinFieldWidths(colWidths)
-        header = GridFormatter(self.headerRows, self.columnCount).formatCellsInGrid(colWidths)
-        body = GridFormatter(self.rows, self.columnCount).formatCellsInGrid(colWidths)
+        header = headerFormatter.formatCellsInGrid(colWidths, headerCellLines)
+        body = bodyFormatter.formatCellsInGrid(colWidths, bodyCellLines)
         line = "_" * sum(colWidths) + "\n"
         return self.formatWithSeparators(header, body, line)
 
@@ -3,8 +3,8 @@
 Logging TreeViews is complicated because there are several ways to set them up
 and little direct support for extracting information from them. So they get their own module.
 """
-import storytext.gtktoolkit.compat
-import gtk, logging
+import storytext.gtktoolkit.compat, storytext.rowbudget
+import gtk, logging, os
 from images import ImageDescriber
 from ..treeviewextract import getAllExtractors
 
@@ -160,6 +160,16 @@ class CellRendererPixbufDescriber(CellRendererDescriber):
             return self.imageDescriber.getPixbufDescription(pixbuf)
 
 
+class RowNode:
+    """ Our copy of a row in the model, as it was last described. Children are None where
+    they have never been described, e.g. below rows that were not expanded """
+    def __init__(self, description=None, inserted=False):
+        self.description = description
+        self.inserted = inserted
+        self.children = []
+        self.rowRef = None
+
+
 # Complicated enough to need its own class...
 class TreeViewDescriber: 
     def __init__(self, view, idleScheduler):
@@ -171,21 +181,91 @@ class TreeViewDescriber:
         self.rendererDescribers = []
         self.describersOK = False
         self.idleScheduler = idleScheduler
+        # Describe model updates by the rows they affect, rather than describing the whole model each time
+        self.rowDiffs = bool(os.getenv("STORYTEXT_TREEVIEW_DIFFS"))
+        self.rootNode = None
+        self.dirtyNodes = []
+        self.removedRows = []
+        self.modelHandlers = []
         if self.model:
             idleScheduler.monitor(self.model, treeModelSignals, "Updated : ", self.view, priority=2)
+            self.monitorRows()
         idleScheduler.monitor(self.view, [ "row-expanded" ], "Expanded row in ", priority=3)
         idleScheduler.monitor(self.view, [ "row-collapsed" ], "Collapsed row in ", priority=3)
         idleScheduler.monitor(self.view.get_selection(), [ "changed" ], "Changed selection in ", self.view, priority=4)
         for column in self.view.get_columns():
             idleScheduler.monitor(column, [ "notify::title" ], "Column titles changed in ", self.view, titleOnly=True)
+        if self.rowDiffs:
+            # These can change which rows are shown, or how, so describe everything next time
+            for widget, signal in [ (self.view, "row-expanded"), (self.view, "row-collapsed"), (self.view.get_selection(), "changed") ]:
+                widget.connect(signal, self.resetRows)
+
+    def monitorRows(self):
+        if self.rowDiffs:
+            self.modelHandlers = [ self.model.connect("row-inserted", self.rowInserted),
+                                   self.model.connect("row-changed", self.rowChanged),
+                                   self.model.connect("row-deleted", self.rowDeleted),
+                                   self.model.connect("rows-reordered", self.resetRows) ]
+
+    def stopMonitoringRows(self):
+        for handler in self.modelHandlers:
+            self.model.disconnect(handler)
+        self.modelHandlers = []
             
     def set_model_on_view(self, model):
+        if self.model:
+            self.stopMonitoringRows()
         self.orig_view_set_model(model)
         self.model = model
         self.rendererDescribers = []
         self.describersOK = False
+        self.resetRows()
+        if self.model:
+            self.monitorRows()
         self.idleScheduler.scheduleDescribe(self.view, prefix="Recreated ")
 
+    def resetRows(self, *args):
+        self.rootNode = None
+        self.dirtyNodes = []
+        self.removedRows = []
+
+    def findNode(self, path):
+        node = self.rootNode
+        for index in path:
+            if node is None or node.children is None or index >= len(node.children):
+                return
+            node = node.children[index]
+        return node
+
+    def markDirty(self, node, path):
+        if node.rowRef is None:
+            node.rowRef = gtk.TreeRowReference(self.model, path)
+            self.dirtyNodes.append(node)
+
+    def rowInserted(self, model, path, *args):
+        parent = self.findNode(path[:-1])
+        if parent is not None and parent.children is not None:
+            node = RowNode(inserted=True)
+            parent.children.insert(path[-1], node)
+            self.markDirty(node, path)
+
+    def rowChanged(self, model, path, *args):
+        node = self.findNode(path)
+        if node is not None:
+            self.markDirty(node, path)
+
+    def rowDeleted(self, model, path):
+        parent = self.findNode(path[:-1])
+        if parent is not None and parent.children is not None and path[-1] < len(parent.children):
+            self.addRemovedRows(parent.children.pop(path[-1]))
+
+    def addRemovedRows(self, node):
+        # Removing a row removes everything below it too
+        if node.description is not None:
+            self.removedRows.append(node.description)
+        for child in node.children or []:
+            self.addRemovedRows(child)
+
     def getDescription(self, prefix):
         columns = self.view.get_columns()
         titles = " , ".join([ column.get_title() or "" for column in columns ])
@@ -193,25 +273,130 @@ class TreeViewDescriber:
         if "Column titles" not in prefix and self.model:
             if not self.describersOK:
                 self.rendererDescribers = self.getRendererDescribers()
-            message += self.getSubTreeDescription(self.model.get_iter_first(), 0)
+            if self.rowDiffs and self.rootNode is not None and prefix.startswith("Updated"):
+                message += self.getRowChangesDescription()
+            else:
+                message += self.getFullDescription()
         return message.rstrip()
+
+    def getFullDescription(self):
+        maxRows = storytext.rowbudget.getMaxRows(self.view)
+        if maxRows:
+            rowsShown = self.getRowsShown()
+            if storytext.rowbudget.isExceeded(maxRows, len(rowsShown)):
+                # We don't keep a copy of rows we didn't describe, so model updates are described like this too
+                self.resetRows()
+                return self.getRowsWithinBudget(rowsShown, maxRows)
+        if self.rowDiffs:
+            self.rootNode = RowNode()
+            self.dirtyNodes = []
+            self.removedRows = []
+            return self.getSubTreeDescription(self.model.get_iter_first(), 0, self.rootNode)
+        else:
+            return self.getSubTreeDescription(self.model.get_iter_first(), 0)
+
+    def getRowsShown(self):
+        rowsShown = []
+        self.addRowsShown(rowsShown, self.model.get_iter_first(), 0)
+        return rowsShown
+
+    def addRowsShown(self, rowsShown, iter, indent):
+        while iter is not None:
+            path = self.model.get_path(iter)
+            rowsShown.append((iter, indent, path))
+            if self.view.row_expanded(path):
+                self.addRowsShown(rowsShown, self.model.iter_children(iter), indent + 1)
+            iter = self.model.iter_next(iter)
+
+    def getVisibleRows(self, rowsShown):
+        visibleRange = self.view.get_visible_range()
+        if visibleRange is None:
+            return 0, 0
+        paths = [ path for _, _, path in rowsShown ]
+        startPath, endPath = visibleRange
+        if startPath in paths and endPath in paths:
+            firstVisible = paths.index(startPath)
+            return firstVisible, paths.index(endPath) - firstVisible + 1
+        else:
+            return 0, 0
+
+    def getRowsWithinBudget(self, rowsShown, maxRows):
+        if len(self.rendererDescribers) == 0: # pragma: no cover - for robustness only
+            return "ERROR: Could not find the relevant column IDs, so cannot describe tree view!"
+        firstVisible, visibleCount = self.getVisibleRows(rowsShown)
+        indices = storytext.rowbudget.selectRows(maxRows, len(rowsShown), firstVisible, visibleCount)
+        lines = [ self.getRowDescription(rowsShown[i][0], rowsShown[i][1]) for i in indices ]
+        lines = storytext.rowbudget.insertGaps(lines, indices, "...")
+        omittedTexts = [ self.getRowValueText(*rowsShown[i][:2]) for i in storytext.rowbudget.getOmittedIndices(indices, len(rowsShown)) ]
+        lines.append(storytext.rowbudget.getSummary(len(indices), len(rowsShown), omittedTexts))
+        return "".join([ line + "\n" for line in lines ])
+
+    def getRowValueText(self, iter, indent):
+        values = [ storytext.rowbudget.getStableText(self.model.get_value(iter, column)) for column in range(self.model.get_n_columns()) ]
+        return str(indent) + "\t" + "\t".join(values)
+
+    def getRowChangesDescription(self):
+        changes = []
+        for node in self.dirtyNodes:
+            path = node.rowRef.get_path() if node.rowRef.valid() else None
+            node.rowRef = None
+            if path is None: # removed since
+                continue
+            if not self.isRowShown(path):
+                # Not described by a full description either. Forget it, expanding its parent describes everything anyway
+                node.description = None
+                continue
+            description = self.getRowDescription(self.model.get_iter(path), len(path) - 1)
+            if node.inserted:
+                changes.append((path, "Inserted row " + self.getPathString(path) + " : " + description))
+            elif description != node.description:
+                changes.append((path, "Changed row " + self.getPathString(path) + " : " + description))
+            node.description = description
+            node.inserted = False
+        changes.sort()
+        lines = [ "Removed row : " + description for description in self.removedRows ] + [ line for _, line in changes ]
+        self.dirtyNodes = []
+        self.removedRows = []
+        return "".join([ line + "\n" for line in lines ])
+
+    def getPathString(self, path):
+        return ":".join(map(str, path))
+
+    def isRowShown(self, path):
+        for i in range(1, len(path)):
+            if not self.view.row_expanded(path[:i]):
+                return False
+        return True
+
+    def getRowDescription(self, iter, indent):
+        colDescriptions = [ d.getDescription(self.model, iter) for d in self.rendererDescribers ]
+        while len(colDescriptions) > 1 and not colDescriptions[-1]:
+            colDescriptions.pop()
+        data = " | ".join(colDescriptions)
+        if self.view.get_selection().iter_is_selected(iter):
+            data += "   ***"
+        return "-> " + " " * 2 * indent + data
     
-    def getSubTreeDescription(self, iter, indent):
+    def getSubTreeDescription(self, iter, indent, parentNode=None):
         if iter is not None and len(self.rendererDescribers) == 0: # pragma: no cover - for robustness only
             return "ERROR: Could not find the relevant column IDs, so cannot describe tree view!"
-        message = ""
+        lines = []
+        self.addSubTreeLines(lines, iter, indent, parentNode)
+        return "".join(lines)
+
+    def addSubTreeLines(self, lines, iter, indent, parentNode):
         while iter is not None:
-            colDescriptions = [ d.getDescription(self.model, iter) for d in self.rendererDescribers ]
-            while len(colDescriptions) > 1 and not colDescriptions[-1]:
-                colDescriptions.pop()
-            data = " | ".join(colDescriptions)
-            if self.view.get_selection().iter_is_selected(iter):
-                data += "   ***"
-            message += "-> " + " " * 2 * indent + data + "\n"
+            description = self.getRowDescription(iter, indent)
+            lines.append(description + "\n")
+            node = None
+            if parentNode is not None:
+                node = RowNode(description)
+                parentNode.children.append(node)
             if self.view.row_expanded(self.model.get_path(iter)):
-                message += self.getSubTreeDescription(self.model.iter_children(iter), indent + 1)
+                self.addSubTreeLines(lines, self.model.iter_children(iter), indent + 1, node)
+            elif node is not None:
+                node.children = None
             iter = self.model.iter_next(iter)
-        return message
 
     def getRendererDescribers(self):
         describers = []
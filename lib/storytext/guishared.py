@@ -2,11 +2,12 @@
 """ Generic module for any kind of Python UI, as distinct from the classes these derive from which contains 
 stuff also applicable even without this """
 
-import scriptengine, replayer, definitions, encodingutils, log
-import os, sys, logging, subprocess, time, re
+import scriptengine, replayer, definitions, encodingutils, log, rowbudget
+import os, sys, logging, subprocess, time, re, atexit, zlib, stat, socket, errno
 from gridformatter import GridFormatter, GridFormatterWithHeader
-from itertools import izip
+from itertools import izip, count
 from random import choice
+from threading import Lock, Timer, Condition, Event
 
 try:
     from collections import OrderedDict
@@ -15,11 +16,21 @@ except ImportError:
 
 from traceback import format_exception
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+try:
+    import cPickle as pickle
+except ImportError: # pragma: no cover - cPickle is always there in our regular tests
+    import pickle
+
 # We really need our ConfigParser to be ordered, copied the one from 2.6 into the repository
 if sys.version_info[:2] >= (2, 6):
-    from ConfigParser import ConfigParser, ParsingError #@UnusedImport
+    from ConfigParser import ConfigParser, ParsingError, NoSectionError, NoOptionError #@UnusedImport
 else: # pragma: no cover - not currently running older than 2.5 in regular tests
-    from ConfigParser26 import ConfigParser, ParsingError #@Reimport
+    from ConfigParser26 import ConfigParser, ParsingError, NoSectionError, NoOptionError #@Reimport
     
 class WidgetAdapter:
     adapterClass = None
@@ -352,6 +363,8 @@ class ScriptEngine(scriptengine.ScriptEngine):
             for subStr in options.min_field_widths.split(","):
                 fieldName, minWidthStr = subStr.split("=")
                 Describer.minFieldWidths[fieldName] = int(minWidthStr)
+        if options.describe_rows:
+            rowbudget.defaultMaxRows = options.describe_rows
         if options.primary_key_columns:
             BaseTableIndexer.primaryKeyColumnTexts += options.primary_key_columns.split(",")
 
@@ -455,39 +468,256 @@ is also supported but will only have features of the listed type described.
         return cls.columnSignalDescs.get(signalName, signalName)
 
 
+def replaceFile(fromFileName, toFileName):
+    if os.pathsep == ";" and os.path.isfile(toFileName): # Windows can't rename over an existing file
+        os.remove(toFileName)
+    os.rename(fromFileName, toFileName)
+
+
+def processExists(pid):
+    # None if we can't tell
+    if not hasattr(os, "kill"):
+        return None
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, e:
+        return e.errno != errno.ESRCH
+
+
+class UIMapJournal:
+    """ Changes made to a UI map file which haven't been written to it yet, so that they
+    survive the process dying before the deferred write happens. Each process has its own journal """
+    def __init__(self, mapFileName):
+        self.prefix = mapFileName + ".journal." + socket.gethostname() + "."
+        self.fileName = self.prefix + str(os.getpid())
+        self.file = None
+
+    def append(self, methodName, args):
+        if self.file is None:
+            dirName = os.path.dirname(self.fileName)
+            if dirName and not os.path.isdir(dirName):
+                os.makedirs(dirName)
+            self.file = open(self.fileName, "ab")
+        pickle.dump((methodName, args), self.file, pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+        if hasattr(os, "fsync"):
+            os.fsync(self.file.fileno())
+
+    def findAbandoned(self):
+        # Journals left by processes on this machine that died. Other machines' processes may still be running
+        dirName, baseName = os.path.split(self.prefix)
+        if dirName and not os.path.isdir(dirName):
+            return []
+        abandoned = []
+        for fileName in os.listdir(dirName or os.curdir):
+            pidText = fileName[len(baseName):]
+            if fileName.startswith(baseName) and pidText.isdigit() and processExists(int(pidText)) is False:
+                abandoned.append(os.path.join(dirName, fileName))
+        return sorted(abandoned)
+
+    @staticmethod
+    def readChanges(fileName):
+        changes = []
+        f = open(fileName, "rb")
+        try:
+            while True:
+                try:
+                    changes.append(pickle.load(f))
+                except Exception:
+                    # End of file, or a change only partly written when we died
+                    break
+        finally:
+            f.close()
+        return changes
+
+    def clear(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.fileName)
+
+
 class WriteParserHandler:
     def __init__(self, fileName, parser):
         self.fileName = fileName
         self.parser = parser
         self.changed = False
+        self.lock = Lock()
+        self.flushTimer = None
+        self.registeredExit = False
+        # Seconds to wait for further changes before writing the file, None means write straight away
+        writeDelay = os.getenv("STORYTEXT_MAP_WRITE_DELAY")
+        self.writeDelay = float(writeDelay) if writeDelay else None
+        if self.writeDelay is not None:
+            self.journal = UIMapJournal(fileName)
+            self.recoverChanges()
+
+    def recoverChanges(self):
+        journalFiles = self.journal.findAbandoned()
+        for journalFile in journalFiles:
+            try:
+                changes = self.journal.readChanges(journalFile)
+            except IOError: # another process recovered it first
+                continue
+            if changes:
+                sys.stderr.write("WARNING: Recovering " + str(len(changes)) + " unsaved change(s) to the UI map file at " + self.fileName + ".\n")
+            for methodName, args in changes:
+                self.replayChange(methodName, args)
+                self.changed = True
+        self.flush()
+        for journalFile in journalFiles:
+            if os.path.isfile(journalFile):
+                os.remove(journalFile)
+
+    def replayChange(self, methodName, args):
+        # The process may have died after writing the file, but before clearing its journal
+        if methodName == "add_section" and self.parser.has_section(*args):
+            return
+        try:
+            getattr(self.parser, methodName)(*args)
+        except (NoSectionError, NoOptionError):
+            pass
 
     def write(self):
-        if self.changed:
-            dirName = os.path.dirname(self.fileName)
-            if dirName and not os.path.isdir(dirName):
-                os.makedirs(dirName)
-            self.parser.write(encodingutils.openEncoded(self.fileName, "w"))
-            self.changed = False
+        if self.writeDelay is None:
+            self.flush()
+        else:
+            self.scheduleFlush()
+
+    def scheduleFlush(self):
+        self.lock.acquire()
+        if self.flushTimer:
+            self.flushTimer.cancel()
+        # Wait for things to go quiet, so several changes give a single write
+        self.flushTimer = Timer(self.writeDelay, self.flush)
+        self.flushTimer.setDaemon(True)
+        self.flushTimer.start()
+        if not self.registeredExit:
+            atexit.register(self.flush)
+            self.registeredExit = True
+        self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.flushTimer:
+                self.flushTimer.cancel()
+                self.flushTimer = None
+            if self.changed:
+                dirName = os.path.dirname(self.fileName)
+                if dirName and not os.path.isdir(dirName):
+                    os.makedirs(dirName)
+                if self.writeDelay is None:
+                    f = encodingutils.openEncoded(self.fileName, "w")
+                    try:
+                        self.parser.write(f)
+                    finally:
+                        f.close()
+                else:
+                    self.writeAtomically()
+                    self.journal.clear()
+                self.changed = False
+        finally:
+            self.lock.release()
+
+    def writeAtomically(self):
+        # Write elsewhere and rename, so the file is never seen half-written.
+        # Write to the target of any link, and keep its permissions
+        realFileName = os.path.realpath(self.fileName)
+        tmpFileName = realFileName + ".tmp" + str(os.getpid())
+        f = encodingutils.openEncoded(tmpFileName, "w")
+        try:
+            self.parser.write(f)
+        finally:
+            f.close()
+        if os.path.isfile(realFileName):
+            os.chmod(tmpFileName, stat.S_IMODE(os.stat(realFileName).st_mode))
+        replaceFile(tmpFileName, realFileName)
+
+    def makeChange(self, methodName, *args):
+        self.lock.acquire()
+        try:
+            self.changed = True
+            if self.writeDelay is not None:
+                self.journal.append(methodName, args)
+            getattr(self.parser, methodName)(*args)
+        finally:
+            self.lock.release()
 
     def add_section(self, *args):
-        self.changed = True
-        self.parser.add_section(*args)
+        self.makeChange("add_section", *args)
 
     def set(self, *args):
-        self.changed = True
-        self.parser.set(*args)
+        self.makeChange("set", *args)
+
+    def remove_option(self, *args):
+        self.makeChange("remove_option", *args)
+
+    def remove_section(self, *args):
+        self.makeChange("remove_section", *args)
 
     def __getattr__(self, name):
         return getattr(self.parser, name)
     
     
+class UIMapCache:
+    """ Sidecar file holding the parsed contents of a UI map file, so that processes sharing
+    large map files don't each parse them again. Only used if enabled via --mapfile-cache """
+    version = 1
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.cacheFileName = fileName + ".cache"
+
+    def getFileInfo(self):
+        try:
+            statInfo = os.stat(self.fileName)
+            return self.version, statInfo.st_mtime, statInfo.st_size
+        except OSError:
+            pass
+
+    def load(self):
+        fileInfo = self.getFileInfo()
+        if fileInfo is None:
+            return
+        try:
+            f = open(self.cacheFileName, "rb")
+            try:
+                cachedFileInfo, contents = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # Missing or unreadable: we'll just parse the file
+            return
+        if cachedFileInfo == fileInfo:
+            return contents
+
+    def save(self, contents):
+        fileInfo = self.getFileInfo()
+        if fileInfo is None:
+            return
+        # Write somewhere else first, so that other processes never see a partial cache
+        tmpFileName = self.cacheFileName + "." + str(os.getpid())
+        try:
+            f = open(tmpFileName, "wb")
+            try:
+                pickle.dump((fileInfo, contents), f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            replaceFile(tmpFileName, self.cacheFileName)
+        except (IOError, OSError):
+            pass # not worth failing over, the map file itself is fine
+
+
 class ParserSectionDict(OrderedDict):
     def __init__(self, fileName, *args, **kw):
         OrderedDict.__init__(self, *args, **kw)
         self.readingFiles = fileName
+        self.duplicatesFound = False
         
     def __getitem__(self, key):
         if self.readingFiles:
+            self.duplicatesFound = True
             msg = "UI map file(s) at " + self.readingFiles + " has duplicated sections for widgets identified by '" + key + "', the earlier ones will be ignored"
             sys.stderr.write("WARNING: " + msg + ".\n")
         return OrderedDict.__getitem__(self, key)
@@ -510,8 +740,13 @@ class UIMapFileParser(ConfigParser):
     def optionxform(self, optionstr):
         return optionstr # don't lowercase
     
-    def read(self, filenames):
+    def read(self, filenames, useCache=False):
         for filename in filenames:
+            if useCache:
+                contents = self.readCached(filename)
+                if contents is not None:
+                    self.addContents(contents)
+                    continue
             try:
                 fp = encodingutils.openEncoded(filename)
             except IOError:
@@ -519,13 +754,145 @@ class UIMapFileParser(ConfigParser):
             self._read(fp, filename)
             fp.close()
         self._sections.readingFiles = None
+
+    def readCached(self, filename):
+        cache = UIMapCache(filename)
+        contents = cache.load()
+        if contents is None and os.path.isfile(filename):
+            parser = UIMapFileParser([ filename ], dict_type=OrderedDict)
+            parser.read([ filename ])
+            contents = parser.getContents()
+            # Don't cache files with duplicated sections, we'd lose the warnings about them
+            if not parser._sections.duplicatesFound:
+                cache.save(contents)
+        return contents
+
+    def getContents(self):
+        sections = [ (section, sectionDict.items()) for section, sectionDict in self._sections.items() ]
+        return self._defaults.items(), sections
+
+    def addContents(self, contents):
+        defaults, sections = contents
+        self._defaults.update(defaults)
+        for section, items in sections:
+            if section in self._sections:
+                sectionDict = self._sections[section] # warns about the duplicate, as when parsing
+            else:
+                sectionDict = self._dict()
+                self._sections[section] = sectionDict
+            sectionDict.update(items)
                 
         
+class OptionValueIndex:
+    """ Finds the UI map entries whose values a command starts with, without scanning every
+    section. Entries are ranked in the same order as the parser would list them """
+    def __init__(self, parser):
+        self.prefixIndex = replayer.CommandNameIndex()
+        self.entriesByValue = {}
+        self.values = {}
+        self.sectionRanks = {}
+        self.optionRanks = {}
+        self.counter = count()
+        for section in parser.sections():
+            self.addSection(section)
+            for option, value in parser.items(section):
+                self.setOption(section, option, value)
+
+    def addSection(self, section):
+        if section not in self.sectionRanks:
+            self.sectionRanks[section] = self.counter.next()
+
+    def removeSection(self, section):
+        for key in self.values.keys():
+            if key[0] == section:
+                self.removeOption(*key)
+        self.sectionRanks.pop(section, None)
+
+    def setOption(self, section, option, value):
+        key = section, option
+        self.addSection(section)
+        if key in self.values:
+            self.discardEntry(key, self.values[key])
+        else:
+            self.optionRanks[key] = self.counter.next()
+        self.values[key] = value
+        if value:
+            if value not in self.entriesByValue:
+                self.prefixIndex.add(value)
+            self.entriesByValue.setdefault(value, set()).add(key)
+
+    def removeOption(self, section, option):
+        key = section, option
+        if key in self.values:
+            self.discardEntry(key, self.values.pop(key))
+            del self.optionRanks[key]
+
+    def discardEntry(self, key, value):
+        # Empty values are never indexed
+        if value in self.entriesByValue:
+            self.entriesByValue[value].discard(key)
+
+    def findEntries(self, text):
+        entries = []
+        for value in self.prefixIndex.findAllPrefixes(text):
+            for section, option in self.entriesByValue.get(value, []):
+                entries.append((self.sectionRanks[section], self.optionRanks[section, option], section, option, value))
+        entries.sort()
+        return [ entry[2:] for entry in entries ]
+
+        
+class RegexSectionMatcher:
+    """ The regular expression sections of the UI map, combined into alternations so that
+    a section name is checked against all of them with a single match call """
+    # Python 2 can't compile more than 100 named groups in one expression
+    maxGroups = 90
+    # Group references would point at the wrong group once combined,
+    # and inline flags like (?i) would apply to all the other sections too
+    ownMatchPattern = re.compile(r"\\[0-9]|\(\?P=|\(\?\(|\(\?[iLmsux]+\)")
+    def __init__(self, regexes):
+        self.alternations = []
+        batch = []
+        for regex in regexes:
+            if self.ownMatchPattern.search(regex.pattern):
+                self.addAlternation(batch)
+                self.alternations.append((regex, [ regex ]))
+                batch = []
+            else:
+                batch.append(regex)
+                if len(batch) == self.maxGroups:
+                    self.addAlternation(batch)
+                    batch = []
+        self.addAlternation(batch)
+
+    def addAlternation(self, batch):
+        if len(batch) > 1:
+            pattern = "|".join(("(?P<section%d>%s)" % (i, regex.pattern) for i, regex in enumerate(batch)))
+            try:
+                self.alternations.append((re.compile(pattern), batch))
+                return
+            except (re.error, AssertionError):
+                pass
+        # Try these one by one
+        self.alternations += [ (regex, [ regex ]) for regex in batch ]
+
+    def match(self, text):
+        for regex, batch in self.alternations:
+            match = regex.match(text)
+            if match:
+                if len(batch) == 1:
+                    return batch[0].pattern
+                for i, section in enumerate(batch):
+                    if match.group("section%d" % i) is not None:
+                        return section.pattern
+
+
 class UIMapFileHandler:
     quoteChars = [ ("'", "APOSTROPHE") ]
     bracketChars = [ ("[", "OPENBRACKET"), ("]", "CLOSEBRACKET")]
     regexChars = re.compile("[\^\$\[\]\{\}\\\*\?\|\+]")
     def __init__(self, uiMapFiles): 
+        self.sectionCacheHits = 0
+        self.sectionCacheMisses = 0
         self.readFiles(uiMapFiles)
         self.regexSections = []
         for section in self.readParser.sections():
@@ -534,6 +901,7 @@ class UIMapFileHandler:
                     self.regexSections.append(re.compile(section))
                 except re.error:
                     pass
+        self.regexSectionMatcher = RegexSectionMatcher(self.regexSections)
                 
     def readFiles(self, uiMapFiles):
         # See top of file: uses the version from 2.6
@@ -542,11 +910,21 @@ class UIMapFileHandler:
             self.readParser = self.writeParsers[0]
         else:
             self.readParser = self.makeParser(uiMapFiles)
+        self.valueIndex = OptionValueIndex(self.readParser)
+        self.clearSectionCache()
+
+    def clearSectionCache(self):
+        # Sections found for each combination of widget identifiers, see UIMap.findSections
+        self.sectionCache = {}
+
+    def getSectionCacheHitRate(self):
+        lookups = self.sectionCacheHits + self.sectionCacheMisses
+        return float(self.sectionCacheHits) / lookups if lookups else 0.0
             
     def makeParser(self, filenames):
         parser = UIMapFileParser(filenames, dict_type=OrderedDict)
         try:
-            parser.read(filenames)
+            parser.read(filenames, useCache=bool(os.getenv("STORYTEXT_MAP_CACHE")))
             return parser
         except ParsingError:
             raise definitions.UseCaseScriptError, "ERROR: could not parse UI map file(s) at " + ",".join(filenames)
@@ -554,13 +932,19 @@ class UIMapFileHandler:
     def storeInfo(self, sectionName, signature, eventName):
         sectionName = self._escape(sectionName, self.bracketChars)
         if not self.readParser.has_section(sectionName):
+            self.clearSectionCache()
             self.writeParsers[-1].add_section(sectionName)
+            if self.writeParsers[-1] is self.readParser:
+                self.valueIndex.addSection(sectionName)
            
         signature = signature.replace("::", "-") # Can't store :: in ConfigParser unfortunately
         if not self.readParser.has_option(sectionName, signature):
+            self.clearSectionCache()
             for writeParser in self.writeParsers:
                 if writeParser.has_section(sectionName):
                     writeParser.set(sectionName, signature, eventName)
+                    if writeParser is self.readParser:
+                        self.valueIndex.setOption(sectionName, signature, eventName)
             
     def findWriteParser(self, section):
         for parser in self.writeParsers:
@@ -571,48 +955,64 @@ class UIMapFileHandler:
         section = self._escape(section, self.bracketChars)
         newSectionName = self._escape(newSectionName, self.bracketChars)
         writeParser = self.findWriteParser(section)
+        # Only need to update the index when it describes the parser we're writing to
+        indexUpdated = writeParser is self.readParser
         removeSection = False
         if not writeParser.has_section(newSectionName):
             writeParser.add_section(newSectionName)
             removeSection = True
+            if indexUpdated:
+                self.valueIndex.addSection(newSectionName)
         for name, value in self.readParser.items(section):
             optName = newOptionName if name == option else name
             if name == option:
                 writeParser.remove_option(newSectionName, option)
+                if indexUpdated:
+                    self.valueIndex.removeOption(newSectionName, option)
             writeParser.set(newSectionName, optName, value)
+            if indexUpdated:
+                self.valueIndex.setOption(newSectionName, optName, value)
 
         if removeSection:
             writeParser.remove_section(section)
+            if indexUpdated:
+                self.valueIndex.removeSection(section)
         writeParser.write()
+        self.clearSectionCache()
         return newSectionName
     
     def write(self, *args):
         for parserHandler in self.writeParsers:
             parserHandler.write()
+        self.clearSectionCache()
+
+    def flush(self):
+        # Checkpoint: make sure any deferred writes have happened
+        for parserHandler in self.writeParsers:
+            parserHandler.flush()
 
     def __getattr__(self, name):
         return getattr(self.readParser, name)
 
     def findSectionsAndOptions(self, valueString):
         details = []
-        for section in self.readParser.sections():
-            for optionName, value in self.readParser.items(section):
-                if value and valueString.startswith(value):
-                    details.append((self._unescape(section, self.bracketChars), optionName))
+        for section, optionName, _ in self.valueIndex.findEntries(valueString):
+            details.append((self._unescape(section, self.bracketChars), optionName))
         return details
 
     def splitOptionValue(self, valueString):
-        for section in self.readParser.sections():
-            for optionName, value in self.readParser.items(section):
-                if value and valueString.startswith(value):
-                    return value, valueString.replace(value, "").strip()
+        for _, _, value in self.valueIndex.findEntries(valueString):
+            return value, valueString.replace(value, "").strip()
         return None, None
     
     def updateOptionValue(self, section, option, newValue):
         section = self._escape(section, self.bracketChars)
         writeParser = self.findWriteParser(section)
         writeParser.set(section, option, newValue)
+        if writeParser is self.readParser:
+            self.valueIndex.setOption(section, option, newValue)
         writeParser.write()
+        self.clearSectionCache()
 
     def hasInfo(self):
         return len(self.readParser.sections()) > 0
@@ -622,9 +1022,7 @@ class UIMapFileHandler:
         if self.readParser.has_section(rawSectionName):
             return section
         
-        for regex in self.regexSections:
-            if regex.match(rawSectionName):
-                return regex.pattern
+        return self.regexSectionMatcher.match(rawSectionName)
 
     def items(self, section):
         return self.readParser.items(self._escape(section, self.bracketChars))
@@ -647,6 +1045,8 @@ class UIMapFileHandler:
 
 class UIMap:
     ignoreWidgetTypes = []
+    # Entries in a widget's section that say how to describe it, rather than naming events
+    describeSettings = [ "DescribeRows" ]
     def __init__(self, scriptEngine, uiMapFiles):
         self.fileHandler = UIMapFileHandler(uiMapFiles)
         self.scriptEngine = scriptEngine
@@ -682,6 +1082,7 @@ class UIMap:
             self.monitor(child, *args, **kw)
 
     def monitorWidget(self, widget):
+        self.storeDescribeSettings(widget)
         signaturesInstrumented, autoInstrumented = self.instrumentFromMapFile(widget)
         if self.scriptEngine.recorderActive() or not self.fileHandler.hasInfo():
             widgetType = widget.getType()
@@ -742,11 +1143,23 @@ class UIMap:
                         signatures.append(sigWithModifiers)
         return signatures
     
+    def storeDescribeSettings(self, widget):
+        for section in self.findSections(widget):
+            for name, value in self.fileHandler.items(section):
+                if name == "DescribeRows":
+                    try:
+                        rowbudget.setWidgetMaxRows(widget.widget, int(value))
+                    except ValueError:
+                        sys.stderr.write(encodingutils.encodeToLocale("ERROR in UI map file: DescribeRows entry in section " +
+                                                                      repr(section) + " should be a number of rows, not " + repr(value) + "\n"))
+
     def findAllSignatureInfo(self, widget):
         info = OrderedDict()
         for section in self.findSections(widget):
             self.logger.debug("Reading map file section " + repr(section) + " for widget of type " + widget.getType())
             for signature, eventName in self.fileHandler.items(section):
+                if signature in self.describeSettings:
+                    continue
                 eventNames = info.setdefault(signature, [])
                 if eventName not in eventNames:
                     eventNames.append(eventName)
@@ -775,7 +1188,9 @@ class UIMap:
             yield tuple(pool[i] for i in indices)
     
     def allUIMapIdCombinations(self, widget):
-        ids = widget.findPossibleUIMapIdentifiers()
+        return self.getIdCombinations(widget.findPossibleUIMapIdentifiers())
+
+    def getIdCombinations(self, ids):
         for i in range(len(ids), 0, -1):
             for sectionNameParts in self.combinations(ids, i):
                 sectionName = ", ".join(sectionNameParts)
@@ -789,9 +1204,24 @@ class UIMap:
             return not sectionName.startswith("Name=")
     
     def findSections(self, widget):
+        ids = tuple(widget.findPossibleUIMapIdentifiers())
+        sections = self.fileHandler.sectionCache.get(ids)
+        if sections is None:
+            self.fileHandler.sectionCacheMisses += 1
+            sections = self.lookUpSections(ids)
+            self.fileHandler.sectionCache[ids] = sections
+        else:
+            self.fileHandler.sectionCacheHits += 1
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Section cache hit rate now " + "%.2f" % self.fileHandler.getSectionCacheHitRate() +
+                              " from " + str(self.fileHandler.sectionCacheHits) + " hits and " +
+                              str(self.fileHandler.sectionCacheMisses) + " misses")
+        return list(sections)
+
+    def lookUpSections(self, ids):
         sections = []
-        for sectionName in self.allUIMapIdCombinations(widget):
-            self.logger.debug("Looking up section name " + repr(sectionName))
+        for sectionName in self.getIdCombinations(ids):
+            self.logger.debug("Looking up section name %r", sectionName)
             actualSection = self.fileHandler.getSection(sectionName)
             if actualSection:
                 sections.append(actualSection)
@@ -806,7 +1236,8 @@ class UIMap:
             return signalName, None
 
     def autoInstrument(self, eventNames, signalName, widget, argumentParseData, *args):
-        self.logger.debug("Monitor " + ",".join(eventNames) + ", " + signalName + ", " + widget.getType() + ", " + str(argumentParseData))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Monitor %s, %s, %s, %s", ",".join(eventNames), signalName, widget.getType(), argumentParseData)
         self.scriptEngine._monitorSignal(eventNames, signalName, widget, argumentParseData)
         return True
         
@@ -817,10 +1248,23 @@ class UseCaseReplayer(replayer.UseCaseReplayer):
         self.readingEnabled = False
         self.uiMap = uiMap
         self.loggerActive = universalLogging
-        self.delay = float(os.getenv("USECASE_REPLAY_DELAY", 0.0))
+        # Turbo mode waits for the application to be idle instead
+        self.delay = 0.0 if self.turbo else float(os.getenv("USECASE_REPLAY_DELAY", 0.0))
         
     def enableReading(self):
         self.readingEnabled = True
+
+    def profileEvent(self, commandName, event):
+        widgetDetails = self.uiMap.findWidgetDetails(commandName) if self.uiMap else []
+        widget = getattr(event, "widget", None)
+        if isinstance(widget, WidgetAdapter):
+            widgetType = widget.getType()
+        elif widget is not None:
+            widgetType = widget.__class__.__name__
+        else:
+            widgetType = None
+        self.profiler.setDetails(**{ "section" : widgetDetails[0][0] if widgetDetails else None,
+                                     "widget type" : widgetType, "event type" : event.__class__.__name__ })
     
     def getParseError(self, scriptCommand):
         widgetDetails = self.uiMap.findWidgetDetails(scriptCommand)
@@ -857,6 +1301,15 @@ class IdleHandlerUseCaseReplayer(UseCaseReplayer):
         self._disableIdleHandlers()
         self.enableReplayHandler()
 
+    def waitUntilIdle(self):
+        # We replay from idle handlers, so the application is idle by definition
+        return True
+
+    def createProfiler(self, fileName):
+        profiler = UseCaseReplayer.createProfiler(self, fileName)
+        self.describeNewWindow = profiler.wrap("describe", self.describeNewWindow)
+        return profiler
+
     def makeDescribeHandler(self, method):
         return self.makeIdleHandler(method)
 
@@ -900,20 +1353,114 @@ class IdleHandlerUseCaseReplayer(UseCaseReplayer):
                     # End of shortcut: reset for next time
                     self.logger.debug("Shortcut terminated: Resetting UI map ready for next shortcut")
                     self.uiMap.windows = [] 
-                    self.events = {}
+                    self.resetEvents()
         if self.readingEnabled:
             return self.callReplayHandlerAgain(*args)
         else:
             return False
-        
+
+
+class FixedRetryPolicy:
+    """ How often to retry finding widgets for a command, and how long to wait in between.
+    The original behaviour: try 50 times, waiting 0.1 seconds each time """
+    attemptCount = 50
+    interval = 0.1
+    def __init__(self):
+        self.retries = 0
+        self.timeWaiting = 0.0
+
+    def canRetry(self):
+        return self.retries < self.attemptCount - 1
+
+    def shouldReportFailure(self):
+        return True
+
+    def getWait(self):
+        return self.interval
+
+    def wait(self, wakeEvent):
+        startTime = time.time()
+        self.sleep(self.getWait(), wakeEvent)
+        self.retries += 1
+        self.timeWaiting += time.time() - startTime
+
+    def sleep(self, waitTime, wakeEvent):
+        time.sleep(waitTime)
+
+
+class BackoffRetryPolicy(FixedRetryPolicy):
+    """ Retries soon at first, waiting twice as long each time up to a maximum, until a deadline.
+    Wakes up early if something happens in the UI """
+    initialWait = 0.001
+    maxWait = 0.1
+    # Waking up early only shortens waits longer than this, so a UI that is always busy doesn't keep us spinning
+    minWait = 0.01
+    timeout = 4.9
+    def __init__(self):
+        FixedRetryPolicy.__init__(self)
+        self.deadline = time.time() + self.timeout
+        self.nextWait = self.initialWait
+        self.lastFailureReport = None
+
+    def canRetry(self):
+        return time.time() < self.deadline
+
+    def shouldReportFailure(self):
+        # Failure handlers may do things like pressing keys, don't call them more often than we used to
+        now = time.time()
+        if self.lastFailureReport is None or now - self.lastFailureReport >= self.maxWait:
+            self.lastFailureReport = now
+            return True
+        else:
+            return False
+
+    def getWait(self):
+        waitTime = min(self.nextWait, max(self.deadline - time.time(), 0))
+        self.nextWait = min(self.nextWait * 2, self.maxWait)
+        return waitTime
+
+    def sleep(self, waitTime, wakeEvent):
+        minWait = min(waitTime, self.minWait)
+        time.sleep(minWait)
+        wakeEvent.wait(waitTime - minWait)
+
+
 # Base class for Java replayers, both of which run in a separate thread
 class ThreadedUseCaseReplayer(UseCaseReplayer):
+    def __init__(self, *args, **kw):
+        # Signalled when reading is enabled, e.g. when the application events we're waiting for arrive
+        self.readingCondition = Condition()
+        self.uiActivity = Event()
+        self.lastRetries = 0, 0.0
+        UseCaseReplayer.__init__(self, *args, **kw)
+
+    def enableReading(self):
+        self.readingCondition.acquire()
+        self.readingEnabled = True
+        self.readingCondition.notifyAll()
+        self.readingCondition.release()
+
     def waitForReenable(self):
         self.logger.debug("Waiting for replaying to be re-enabled...")
+        self.readingCondition.acquire()
         while not self.readingEnabled:
-            time.sleep(0.1) # don't use the whole CPU while waiting
+            self.readingCondition.wait()
+        self.readingCondition.release()
+
+    def updateReadingEnabled(self):
+        # Must not overwrite the event thread enabling reading in between
+        self.readingCondition.acquire()
+        self.readingEnabled = self.waitingCompleted()
+        self.readingCondition.release()
+
+    def createProfiler(self, fileName):
+        profiler = UseCaseReplayer.createProfiler(self, fileName)
+        self.checkWidgetStatus = profiler.wrap("widget status", self.checkWidgetStatus)
+        return profiler
 
     def describeAndRun(self, describeMethod, replayFailureMethod=None):
+        if self.profiler:
+            describeMethod = self.profiler.wrap("describe", describeMethod)
         if not self.readingEnabled:
             self.waitForReenable()
         while True:
@@ -922,31 +1469,56 @@ class ThreadedUseCaseReplayer(UseCaseReplayer):
                 time.sleep(self.delay)
             proceed, wait = self.runNextCommand(describeMethod=describeMethod, replayFailureMethod=replayFailureMethod)
             if not proceed:
-                self.readingEnabled = self.waitingCompleted()
+                self.updateReadingEnabled()
                 if wait:
                     self.waitForReenable()
                 else:
                     self.logger.debug("No command to run, no waiting to do: exiting replayer")
                     break
 
+    def createRetryPolicy(self):
+        if self.turbo:
+            return BackoffRetryPolicy()
+        else:
+            return FixedRetryPolicy()
+
+    def notifyUIActivity(self):
+        # New widgets or display events: whatever we're retrying might work now
+        self.uiActivity.set()
+
     def tryParseRepeatedly(self, commandWithArg, replayFailureMethod):
-        attemptCount = 50
+        retryPolicy = self.createRetryPolicy()
         command = None
-        for attempt in range(attemptCount):
+        while True:
+            self.uiActivity.clear()
             try:
                 command, argumentString = self.parseCommand(commandWithArg)
                 event, parsedArguments = self.checkWidgetStatus(command, argumentString)
+                self.recordRetries(commandWithArg, retryPolicy)
                 return command, argumentString, event, parsedArguments
             except definitions.UseCaseScriptError:
                 # We don't terminate scripts if they contain errors
-                if attempt == attemptCount - 1:
+                if not retryPolicy.canRetry():
+                    self.recordRetries(commandWithArg, retryPolicy)
                     raise
                 else:
                     type, value, _ = sys.exc_info()
                     self.logger.debug("Error, final event failed, waiting and retrying: " + str(value))
-                    if replayFailureMethod:
+                    if replayFailureMethod and retryPolicy.shouldReportFailure():
                         replayFailureMethod(str(value), self.events.get(command, []))
-                    time.sleep(0.1)
+                    startTime = time.time()
+                    if self.turbo:
+                        self.waitUntilIdle()
+                    retryPolicy.wait(self.uiActivity)
+                    self.timeWaiting += time.time() - startTime
+
+    def recordRetries(self, commandWithArg, retryPolicy):
+        self.lastRetries = retryPolicy.retries, retryPolicy.timeWaiting
+        if self.profiler:
+            self.profiler.setDetails(retries=retryPolicy.retries, retryWait=retryPolicy.timeWaiting * 1000)
+        if retryPolicy.retries:
+            self.logger.debug("Retried " + repr(commandWithArg) + " " + str(retryPolicy.retries) + " times, waiting " + \
+                              "%.1f" % (retryPolicy.timeWaiting * 1000) + "ms")
         
     def checkAndParse(self, event, compositeEventProxy):
         event.checkWidgetStatus()
@@ -1060,7 +1632,9 @@ class ThreadedUseCaseReplayer(UseCaseReplayer):
         if event:
             self.describeEvent(commandName, argumentString)
             self.writeWarnings(event)
-            event.generate(parsedArguments)
+            if self.profiler:
+                self.profileEvent(commandName, event)
+            self.generateEvent(event, parsedArguments)
         else:
             self.processSignalCommand(argumentString)
                 
@@ -1100,6 +1674,22 @@ class WidgetCounter:
 
 
 
+class StoredState:
+    # State of a widget described from contents, see Describer.getStateContents.
+    # Checked for changes by comparing fingerprints of the contents, the text is only needed when it has changed
+    compressSize = 1000
+    def __init__(self, fingerprint, text):
+        self.fingerprint = fingerprint
+        self.isUnicode = isinstance(text, unicode)
+        data = text.encode("utf-8") if self.isUnicode else text
+        self.compressed = len(data) > self.compressSize
+        self.data = zlib.compress(data) if self.compressed else data
+
+    def getText(self):
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        return data.decode("utf-8") if self.isUnicode else data
+
+
 # Base class for everything except GTK's describer, which works a bit differently
 class Describer(object):
     maxOutputWidth = 130
@@ -1113,6 +1703,10 @@ class Describer(object):
         self.logger = encodingutils.getEncodedLogger("gui log")
         self.windows = set()
         self.widgetsWithState = OrderedDict()
+        # Toolkits that hear about widget updates only check the widgets they've heard about, see markDirty
+        dirtyTracking = os.getenv("STORYTEXT_DIRTY_TRACKING")
+        self.dirtyWidgets = set() if dirtyTracking and self.canTrackDirtyWidgets() else None
+        self.verifyDirtyWidgets = self.dirtyWidgets is not None and dirtyTracking == "verify"
         if Describer.imageCounter is None:
             Describer.imageCounter = WidgetCounter(self.imagesEqual)
         self.structureLog = log.getLogger("widget structure")
@@ -1146,15 +1740,38 @@ class Describer(object):
     def getWindowString(self):
         return "Window"
 
+    def canTrackDirtyWidgets(self):
+        return False
+
+    def markDirty(self, widget):
+        if self.dirtyWidgets is not None and widget in self.widgetsWithState:
+            self.dirtyWidgets.add(widget)
+
+    def isDirty(self, widget):
+        return self.dirtyWidgets is None or widget in self.dirtyWidgets
+
     def findStateChanges(self, *args):
         defunctWidgets = []
         stateChanges = []
         for widget, oldState in self.widgetsWithState.items():
             if not self.shouldCheckForUpdates(widget, *args):
                 continue
+
+            dirty = self.isDirty(widget)
+            if not dirty and not self.verifyDirtyWidgets:
+                continue
+            if self.dirtyWidgets:
+                self.dirtyWidgets.discard(widget)
             
             try:
-                state = self.getState(widget)
+                if isinstance(oldState, StoredState):
+                    contents = self.getStateContents(widget)
+                    fingerprint = self.getFingerprint(contents)
+                    if fingerprint == oldState.fingerprint:
+                        continue
+                    state = self.formatStateContents(widget, contents)
+                else:
+                    state = self.getState(widget)
             except:
                 # If the frame where it existed has been removed, for example...
                 message = "Warning: The following exception has been thrown:\n"
@@ -1166,12 +1783,19 @@ class Describer(object):
                 defunctWidgets.append(widget)
                 continue
 
+            if isinstance(oldState, StoredState):
+                self.widgetsWithState[widget] = StoredState(fingerprint, state)
+                oldState = oldState.getText()
+            elif state != oldState:
+                self.widgetsWithState[widget] = state
             if state != oldState:
+                if not dirty:
+                    sys.stderr.write("StoryText dirty tracking missed a state change in " + self.getRawData(widget) + "\n")
                 stateChanges.append((widget, oldState, state))
-                self.widgetsWithState[widget] = state
             
         for widget in defunctWidgets:
             del self.widgetsWithState[widget]
+            rowbudget.forgetWidget(widget)
         return stateChanges
 
     def shouldCheckForUpdates(self, *args):
@@ -1265,6 +1889,22 @@ class Describer(object):
                 return getattr(self, methodName)(widget)
         return ""
 
+    def getStateContents(self, widget):
+        # Widgets with large states can provide what they're formatted from, which is much cheaper to compare
+        for widgetClass in self.stateWidgets:
+            if isinstance(widget, widgetClass):
+                method = getattr(self, "get" + widgetClass.__name__ + "Contents", None)
+                return method(widget) if method else None
+
+    def formatStateContents(self, widget, contents):
+        for widgetClass in self.stateWidgets:
+            if isinstance(widget, widgetClass):
+                methodName = "format" + widgetClass.__name__ + "Contents"
+                return getattr(self, methodName)(contents).strip()
+
+    def getFingerprint(self, contents):
+        return md5(repr(contents)).digest()
+
     def addMultilineData(self, elements, rows, separator=""):
         for elIx, el in enumerate(elements):
             elRows = el.split("\n")
@@ -1353,8 +1993,14 @@ class Describer(object):
             self.describeStructure(child, indent+1, **kw)
                 
     def getAndStoreState(self, widget):
-        state = self.getState(widget)
-        self.widgetsWithState[widget] = state
+        contents = self.getStateContents(widget)
+        if contents is None:
+            state = self.getState(widget)
+            self.widgetsWithState[widget] = state
+        else:
+            fingerprint = self.getFingerprint(contents)
+            state = self.formatStateContents(widget, contents)
+            self.widgetsWithState[widget] = StoredState(fingerprint, state)
         return state
 
     def getItemDescription(self, item, prefix, *args):
@@ -0,0 +1,89 @@
+
+""" Lets threads hand over work that must be done while holding a lock, without waiting for the lock.
+The work is queued, and whichever thread holds the lock does everything queued so far, in order.
+The lock is reentrant, so the thread holding it can still submit work or take it again.
+Set STORYTEXT_LOCK_CONTENTION to report how long threads waited for such locks on exit """
+
+from collections import deque
+from threading import RLock
+import os, sys, time, atexit
+from traceback import format_exception
+
+class ContentionStats:
+    def __init__(self, name):
+        self.name = name
+        self.submitted = 0
+        self.handedOver = 0
+        self.waits = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        atexit.register(self.report)
+
+    def addWait(self, waitTime):
+        self.waits += 1
+        self.totalWait += waitTime
+        self.maxWait = max(self.maxWait, waitTime)
+
+    def report(self):
+        sys.stderr.write("Lock contention for " + self.name + ": " + str(self.handedOver) + " of " + str(self.submitted) + \
+                         " submissions handed over to another thread, " + str(self.waits) + " waits for the lock totalling " + \
+                         "%.3f" % (self.totalWait * 1000) + "ms, longest " + "%.3f" % (self.maxWait * 1000) + "ms\n")
+
+
+class IngestionQueue:
+    def __init__(self, name):
+        self.lock = RLock()
+        self.queue = deque()
+        self.stats = ContentionStats(name) if os.getenv("STORYTEXT_LOCK_CONTENTION") else None
+
+    def submit(self, method, *args, **kw):
+        self.queue.append((method, args, kw))
+        if self.stats:
+            self.stats.submitted += 1
+            if not self.tryProcess():
+                self.stats.handedOver += 1
+        else:
+            self.tryProcess()
+
+    def call(self, method, *args, **kw):
+        # For work that must be done before we return
+        self.acquire()
+        try:
+            return method(*args, **kw)
+        finally:
+            self.release()
+
+    def tryProcess(self):
+        processed = False
+        # If someone else has the lock, they will do our work before releasing it
+        # Check again once we've released it, in case something was queued just as we did so
+        while self.queue and self.lock.acquire(False):
+            try:
+                self.processQueue()
+                processed = True
+            finally:
+                self.lock.release()
+        return processed
+
+    def processQueue(self):
+        while self.queue:
+            method, args, kw = self.queue.popleft()
+            try:
+                method(*args, **kw)
+            except:
+                # Don't let one thread's work stop another's
+                sys.stderr.write("".join(format_exception(*sys.exc_info())))
+
+    def acquire(self):
+        if self.stats:
+            startTime = time.time()
+            self.lock.acquire()
+            self.stats.addWait(time.time() - startTime)
+        else:
+            self.lock.acquire()
+        self.processQueue()
+
+    def release(self):
+        self.processQueue()
+        self.lock.release()
+        self.tryProcess()
@@ -4,7 +4,8 @@
 
 import logging, os
 import storytext.guishared
-from threading import Lock, currentThread
+from storytext.ingestion import IngestionQueue
+from threading import currentThread
 from copy import copy
 from storytext.javaswttoolkit.simulator import DisplayFilter
 
@@ -21,7 +22,8 @@ class JobListener(JobChangeAdapter):
         self.jobCount = 0
         self.eventsSeenOtherListener = set()
         self.customUsageMethod = None
-        self.jobCountLock = Lock()
+        # Job threads hand over their events rather than waiting for each other
+        self.jobQueue = IngestionQueue("Eclipse RCP jobs")
         self.logger = logging.getLogger("Eclipse RCP jobs")
 
     def makeCopy(self):
@@ -30,12 +32,13 @@ class JobListener(JobChangeAdapter):
         cp.jobCount = self.jobCount
         cp.eventsSeenOtherListener = self.eventsSeenOtherListener
         cp.customUsageMethod = self.customUsageMethod
-        cp.jobCountLock = self.jobCountLock
+        cp.jobQueue = self.jobQueue
         cp.logger = self.logger
         return cp
 
     def done(self, e):
-        storytext.guishared.catchAll(self.lockAndCheck, e, self.__class__.jobDone)
+        # Don't return until it's handled: the job isn't really finished until everything reacting to it is
+        storytext.guishared.catchAll(self.jobQueue.call, self.check, e, self.__class__.jobDone)
         
     def jobDone(self, e):
         jobName = e.getJob().getName().lower()
@@ -56,28 +59,27 @@ class JobListener(JobChangeAdapter):
         self.jobNamesToUse = {}
 
     def scheduled(self, e):
-        storytext.guishared.catchAll(self.lockAndCheck, e, self.__class__.registerScheduled)
+        # Find out about the scheduling thread here, the event may be handled in another one
+        parentJob = Job.getJobManager().currentJob()
+        threadName = currentThread().getName()
+        self.jobQueue.submit(storytext.guishared.catchAll, self.check, e, self.__class__.registerScheduled, parentJob, threadName)
         
-    def lockAndCheck(self, e, func):
-        self.jobCountLock.acquire()
+    def check(self, e, func, *args):
         if e not in self.eventsSeenOtherListener:
             if self is self.instance:
-                func(self, e)
+                func(self, e, *args)
             else:
                 self.logger.debug("This event received during transfer, using other listener")
                 self.instance.eventsSeenOtherListener.add(e)
-                func(self.instance, e)
+                func(self.instance, e, *args)
         else:
             self.logger.debug("Event previously handled during transfer, discarding")
-        self.jobCountLock.release()
 
-    def registerScheduled(self, event):
+    def registerScheduled(self, event, parentJob, threadName):
         job = event.getJob()
-        parentJob = Job.getJobManager().currentJob()
         jobName = job.getName().lower()
         self.jobCount += 1
         parentJobName = parentJob.getName().lower() if parentJob else ""
-        threadName = currentThread().getName()
         category = "jobs_" + threadName
         postfix = ", parent job " + parentJobName if parentJobName else "" 
         self.logger.debug("Scheduled job '" + jobName + "' jobs = " + repr(self.jobCount) + ", thread = " + threadName + postfix)
@@ -105,14 +107,14 @@ class JobListener(JobChangeAdapter):
         Job.getJobManager().addJobChangeListener(self)
         
     def transferListener(self):
-        self.jobCountLock.acquire()
+        self.jobQueue.acquire()
         # We need to be after all the application's code reacting to the job, so we truly respond when it's finished
         self.logger.debug("Transferring Job Change Listener in thread " + currentThread().getName())
         newListener = self.makeCopy()
         JobListener.instance = newListener
         Job.getJobManager().addJobChangeListener(newListener)
         Job.getJobManager().removeJobChangeListener(self)
-        self.jobCountLock.release()    
+        self.jobQueue.release()
 
     @classmethod
     def enable(cls, *args):
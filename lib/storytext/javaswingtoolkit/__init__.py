@@ -107,6 +107,7 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
         util.runOnEventDispatchThread(Toolkit.getDefaultToolkit().addAWTEventListener, NewComponentListener(), eventMask)
 
     def handleNewComponent(self, widget):
+        self.notifyUIActivity()
         inWindow = isinstance(widget, JComponent) and widget.getTopLevelAncestor() is not None and \
                    widget.getTopLevelAncestor() in self.uiMap.windows
         isWindow = isinstance(widget, (JFrame, JDialog))
@@ -134,6 +135,11 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
     def describe(self):
         util.runOnEventDispatchThread(self.describer.describeWithUpdates)
 
+    def waitUntilIdle(self):
+        # Returns once the event dispatch thread has got through everything already queued for it
+        util.runOnEventDispatchThread(lambda: None)
+        return True
+
     def runTestThread(self):
         util.runOnEventDispatchThread(self.waitForApplicationToAppear)
         if self.isActive():
@@ -1,4 +1,4 @@
-import storytext.guishared, logging, util, os, inspect
+import storytext.guishared, storytext.rowbudget, logging, util, os, inspect
 from itertools import izip
 
 from java.awt import BorderLayout, FlowLayout, GridBagConstraints, GridBagLayout, GridLayout
@@ -511,18 +511,49 @@ class Describer(storytext.guishared.Describer):
         textFinder = util.ComponentTextFinder(table, describe=True)
         headerRow = map(textFinder.getJTableHeaderText, range(columnCount))
         args = textFinder, selectedRows, selectedColumns
-        rows = [ [ self.getFullCellText(i, j, *args) for j in range(columnCount) ] for i in range(table.getRowCount()) ]
+        rowCount = table.getRowCount()
+        maxRows = storytext.rowbudget.getMaxRows(table)
+        summary = None
+        if storytext.rowbudget.isExceeded(maxRows, rowCount):
+            rect = table.getVisibleRect()
+            rowHeight = max(table.getRowHeight(), 1)
+            indices = storytext.rowbudget.selectRows(maxRows, rowCount, rect.y // rowHeight, rect.height // rowHeight + 1)
+            rows = [ [ self.getFullCellText(i, j, *args) for j in range(columnCount) ] for i in indices ]
+            rows = storytext.rowbudget.insertGaps(rows, indices, [ "..." ] * columnCount)
+            omittedTexts = [ "\t".join([ storytext.rowbudget.getStableText(table.getValueAt(i, j)) for j in range(columnCount) ])
+                             for i in storytext.rowbudget.getOmittedIndices(indices, rowCount) ]
+            summary = storytext.rowbudget.getSummary(len(indices), rowCount, omittedTexts)
+        else:
+            rows = [ [ self.getFullCellText(i, j, *args) for j in range(columnCount) ] for i in range(rowCount) ]
 
         text = self.combineElements([ "Table" ] + self.getPropertyElements(table)) + " :\n"
-        return text + self.formatTable(headerRow, rows, columnCount)
+        text += self.formatTable(headerRow, rows, columnCount)
+        return storytext.rowbudget.addSummary(text, summary) if summary else text
 
     def getJTreeState(self, tree):
         selectedRows = tree.getSelectionRows() or []
         rowCount = tree.getRowCount()
         textFinder = util.ComponentTextFinder(tree, describe=True)
-        rows = [ self.getTreeRowText(i, textFinder, selectedRows)  for i in range(rowCount) ]
+        maxRows = storytext.rowbudget.getMaxRows(tree)
         text = self.combineElements([ "Tree" ] + self.getPropertyElements(tree)) + " :\n"
-        return text + "\n".join(rows)
+        if storytext.rowbudget.isExceeded(maxRows, rowCount):
+            rect = tree.getVisibleRect()
+            firstVisible = tree.getClosestRowForLocation(rect.x, rect.y)
+            lastVisible = tree.getClosestRowForLocation(rect.x, rect.y + rect.height - 1)
+            indices = storytext.rowbudget.selectRows(maxRows, rowCount, firstVisible, lastVisible - firstVisible + 1)
+            rows = [ self.getTreeRowText(i, textFinder, selectedRows) for i in indices ]
+            rows = storytext.rowbudget.insertGaps(rows, indices, "...")
+            omittedTexts = [ self.getTreeValueText(tree, i) for i in storytext.rowbudget.getOmittedIndices(indices, rowCount) ]
+            return storytext.rowbudget.addSummary(text + "\n".join(rows), storytext.rowbudget.getSummary(len(indices), rowCount, omittedTexts))
+        else:
+            rows = [ self.getTreeRowText(i, textFinder, selectedRows)  for i in range(rowCount) ]
+            return text + "\n".join(rows)
+
+    def getTreeValueText(self, tree, row):
+        path = tree.getPathForRow(row)
+        node = path.getLastPathComponent()
+        # Include the depth, so moving a row to another parent changes the hash
+        return str(path.getPathCount()) + " " + tree.convertValueToText(node, False, tree.isExpanded(row), tree.getModel().isLeaf(node), row, False)
     
     def getUpdatePrefix(self, widget, oldState, state):
         return "\nUpdated " + self.getFieldPrefix(widget)
@@ -99,6 +99,12 @@ class UseCaseReplayer(storytext.guishared.ThreadedUseCaseReplayer):
             runOnUIThread(describer.describeWithUpdates, monitor.getActiveShell)
         self.describeAndRun(describe, monitor.handleReplayFailure)
         
+    def waitUntilIdle(self):
+        from simulator import runOnUIThread
+        # Returns once the UI thread has got through everything already queued for it
+        runOnUIThread(lambda: None)
+        return True
+
     def shouldReraise(self, e, clsName, modNames):
         msg = str(e).strip()
         allowedMessages = [ "No module named " + modName for modName in modNames ]
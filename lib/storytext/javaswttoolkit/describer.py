@@ -1,5 +1,5 @@
 
-import storytext.guishared, util, types, logging, sys, os
+import storytext.guishared, storytext.rowbudget, util, types, logging, sys, os
 from storytext.definitions import UseCaseScriptError
 from storytext.gridformatter import GridFormatter
 
@@ -228,7 +228,22 @@ class Describer(storytext.guishared.Describer):
         else:
             return "Image"        
 
+    def canTrackDirtyWidgets(self):
+        return True
+
+    def isDirty(self, widget):
+        # Menus don't send paint events, and the tab order can change without the widget itself changing
+        return isinstance(widget, (Shell, Menu)) or self.checkTabOrder() or \
+               storytext.guishared.Describer.isDirty(self, widget)
+
+    def setWidgetDirty(self, widget):
+        if isinstance(widget, Item):
+            self.markDirty(widget.getParent())
+        else:
+            self.markDirty(widget)
+
     def setWidgetPainted(self, widget):
+        self.markDirty(widget)
         if widget not in self.widgetsDescribed and widget not in self.windows and widget not in self.widgetsAppeared:
             self.logger.debug("Widget painted " + self.getRawData(widget))
             self.widgetsAppeared.append(widget)
@@ -236,6 +251,8 @@ class Describer(storytext.guishared.Describer):
     def setWidgetShown(self, widget):
         # Menu show events seem a bit spurious, they aren't really shown at this point:
         # ScrollBar shows are not relevant to anything
+        if isinstance(widget, Control):
+            self.setWidgetHidden(widget)
         if isinstance(widget, Control) and widget not in self.widgetsAppeared:
             self.logger.debug("Widget shown " + self.getRawData(widget))
             self.widgetsAppeared.append(widget)
@@ -247,10 +264,20 @@ class Describer(storytext.guishared.Describer):
             self.logger.debug("Widget moved " + self.getRawData(widget))
             self.widgetsMoved.append(widget)
         
+    def setWidgetHidden(self, widget):
+        # The parent may be showing a different top control
+        self.markDirty(widget)
+        self.markDirty(widget.getParent())
+
     def setWidgetResized(self, widget):
         if isinstance(widget, Control):
+            self.setWidgetHidden(widget)
             self.parentsResized.add(widget)
             self.parentsResized.add(widget.getParent())
+
+    def setWidgetDisposed(self, widget):
+        self.setWidgetResized(widget)
+        storytext.rowbudget.forgetWidget(widget)
                     
     def addFilters(self, display):
         class ShowListener(Listener):
@@ -269,11 +296,32 @@ class Describer(storytext.guishared.Describer):
             def handleEvent(listenerSelf, e): #@NoSelf
                 storytext.guishared.catchAll(self.setWidgetResized, e.widget)
 
+        class DisposeListener(Listener):
+            def handleEvent(listenerSelf, e): #@NoSelf
+                storytext.guishared.catchAll(self.setWidgetDisposed, e.widget)
+
         display.addFilter(SWT.Show, ShowListener())
         display.addFilter(SWT.Paint, PaintListener())
         display.addFilter(SWT.Move, MoveListener())
         display.addFilter(SWT.Resize, ResizeListener())
-        display.addFilter(SWT.Dispose, ResizeListener()) # Being disposed is the ultimate resize :)
+        display.addFilter(SWT.Dispose, DisposeListener()) # Being disposed is the ultimate resize :)
+        if self.dirtyWidgets is not None:
+            self.addDirtyFilters(display)
+
+    def addDirtyFilters(self, display):
+        # Changes that may not cause the widget to be repainted
+        class HideListener(Listener):
+            def handleEvent(listenerSelf, e): #@NoSelf
+                if isinstance(e.widget, Control):
+                    storytext.guishared.catchAll(self.setWidgetHidden, e.widget)
+
+        class DirtyListener(Listener):
+            def handleEvent(listenerSelf, e): #@NoSelf
+                storytext.guishared.catchAll(self.setWidgetDirty, e.widget)
+
+        display.addFilter(SWT.Hide, HideListener())
+        for eventType in [ SWT.Modify, SWT.Selection, SWT.DefaultSelection, SWT.Expand, SWT.Collapse, SWT.SetData ]:
+            display.addFilter(eventType, DirtyListener())
 
     def getScreenshotFileName(self, screenshotDir):
         return os.path.join(screenshotDir, "screenshot" + str(self.screenshotNumber) + ".png")
@@ -305,6 +353,9 @@ class Describer(storytext.guishared.Describer):
             self.colorsAdded = True
             colorNameFinder.addSWTColors(shell.getDisplay())
         if shell is not None:
+            if self.dirtyWidgets is not None:
+                # Process outstanding paints now, so they mark what has changed
+                shell.update()
             if self.checkTabOrder():
                 _, oldDescribeOrder = self.tabOrders.get(shell, ([], []))
                 newTabOrder = self.getTabOrderList(shell, [])
@@ -849,29 +900,105 @@ class Describer(storytext.guishared.Describer):
                 return "Custom Tooltip " + self.customTooltipCounter.getId((jfaceTooltip, item))
 
     def getTreeState(self, widget):
+        return self.formatTreeContents(self.getTreeContents(widget))
+
+    def getTreeContents(self, widget):
         columns = widget.getColumns()
         columnCount = len(columns)
         props, jfaceTooltip = self.getPropertyElementsAndTooltip(widget)
+        maxRows = storytext.rowbudget.getMaxRows(widget)
+        itemsShown = self.getTreeItemsShown(widget) if maxRows else []
+        if storytext.rowbudget.isExceeded(maxRows, len(itemsShown)):
+            rows, summary = self.getTreeRowsWithinBudget(widget, itemsShown, maxRows, columnCount, jfaceTooltip)
+        else:
+            rows = self.getAllItemDescriptions(widget, indent=0, subItemMethod=self.getSubTreeDescriptions,
+                                               prefix="-> ", selection=widget.getSelection(),
+                                               columnCount=columnCount, enclosingJfaceTooltip=jfaceTooltip)
+            summary = None
+        return props, [ c.getText() for c in columns ], rows, summary
+
+    def formatTreeContents(self, contents):
+        props, headerRow, rows, summary = contents
         text = self.combineElements([ "Tree" ] + props) + " :\n"
-        rows = self.getAllItemDescriptions(widget, indent=0, subItemMethod=self.getSubTreeDescriptions,
-                                           prefix="-> ", selection=widget.getSelection(),
-                                           columnCount=columnCount, enclosingJfaceTooltip=jfaceTooltip)
-        if columnCount > 0:
-            rows.insert(0, [ c.getText() for c in columns ])
-            text += str(GridFormatter(rows, columnCount))
+        if headerRow:
+            text += str(GridFormatter([ headerRow ] + rows, len(headerRow)))
         else:
             text += "\n".join(rows)
-        return text
+        return storytext.rowbudget.addSummary(text, summary) if summary else text
+
+    def getTreeItemsShown(self, widget):
+        itemsShown = []
+        self.addTreeItemsShown(itemsShown, widget.getItems(), 0)
+        return itemsShown
+
+    def addTreeItemsShown(self, itemsShown, items, indent):
+        for item in items:
+            itemsShown.append((item, indent))
+            if item.getExpanded():
+                self.addTreeItemsShown(itemsShown, item.getItems(), indent + 1)
+
+    def getVisibleItemCount(self, widget):
+        return widget.getClientArea().height // max(widget.getItemHeight(), 1) + 1
+
+    def getTreeRowsWithinBudget(self, widget, itemsShown, maxRows, columnCount, jfaceTooltip):
+        topItem = widget.getTopItem()
+        topIndex = 0
+        for i, (item, _) in enumerate(itemsShown):
+            if item == topItem:
+                topIndex = i
+                break
+        indices = storytext.rowbudget.selectRows(maxRows, len(itemsShown), topIndex, self.getVisibleItemCount(widget))
+        selection = widget.getSelection()
+        rows = []
+        for i in indices:
+            item, indent = itemsShown[i]
+            currPrefix = "-> " + " " * indent * 2
+            selected = item in selection or (hasattr(item, "getSelection") and item.getSelection())
+            if columnCount:
+                rows.append([ self.getItemColumnDescription(item, col, currPrefix, selected, jfaceTooltip) for col in range(columnCount) ])
+            else:
+                rows.append(self.getItemDescription(item, currPrefix, selected, jfaceTooltip))
+        gapRow = [ "..." ] * columnCount if columnCount else "..."
+        rows = storytext.rowbudget.insertGaps(rows, indices, gapRow)
+        if not columnCount:
+            # Left out when describing every row, so leave them out here too, after the gaps are placed
+            rows = filter(None, rows)
+        omittedTexts = [ self.getItemTexts(itemsShown[i][0], columnCount) for i in storytext.rowbudget.getOmittedIndices(indices, len(itemsShown)) ]
+        return rows, storytext.rowbudget.getSummary(len(indices), len(itemsShown), omittedTexts)
+
+    def getItemTexts(self, item, columnCount):
+        if columnCount:
+            return "\t".join([ item.getText(col) for col in range(columnCount) ])
+        else:
+            return item.getText()
 
     def getTableState(self, widget):
+        return self.formatTableContents(self.getTableContents(widget))
+
+    def getTableContents(self, widget):
         columns = widget.getColumns()
         columnCount = len(columns)
         props, jfaceTooltip = self.getPropertyElementsAndTooltip(widget)
-        text = self.combineElements([ "Table" ] + props) + " :\n"
-        rows = self.getAllTableItemDescriptions(widget, indent=0, 
-                                                selection=widget.getSelection(),
-                                                columnCount=columnCount,
-                                                enclosingJfaceTooltip=jfaceTooltip)
+        items = widget.getItems()
+        maxRows = storytext.rowbudget.getMaxRows(widget)
+        summary = None
+        if storytext.rowbudget.isExceeded(maxRows, len(items)):
+            indices = storytext.rowbudget.selectRows(maxRows, len(items), widget.getTopIndex(), self.getVisibleItemCount(widget))
+            rows = self.getAllTableItemDescriptions(widget, indent=0, 
+                                                    selection=widget.getSelection(),
+                                                    columnCount=columnCount,
+                                                    enclosingJfaceTooltip=jfaceTooltip,
+                                                    items=[ items[i] for i in indices ])
+            gapRow = [ "..." ] * len(rows[0])
+            rows = storytext.rowbudget.insertGaps(rows, indices, gapRow)
+            omittedTexts = [ self.getItemTexts(items[i], columnCount) for i in storytext.rowbudget.getOmittedIndices(indices, len(items)) ]
+            summary = storytext.rowbudget.getSummary(len(indices), len(items), omittedTexts)
+        else:
+            rows = self.getAllTableItemDescriptions(widget, indent=0, 
+                                                    selection=widget.getSelection(),
+                                                    columnCount=columnCount,
+                                                    enclosingJfaceTooltip=jfaceTooltip,
+                                                    items=items)
         sortColumn = widget.getSortColumn()
         if widget.getSortDirection() == SWT.UP:
             sortDirection = "(->)"
@@ -880,12 +1007,20 @@ class Describer(storytext.guishared.Describer):
         else:
             sortDirection = ""
         headerRow = [ c.getText() + sortDirection  if c == sortColumn else c.getText() for c in columns if c.getWidth() > 0] # Don't show hidden columns
-        return text + self.formatTable(headerRow, rows, max(1, columnCount))
+        return props, headerRow, rows, columnCount, summary
+
+    def formatTableContents(self, contents):
+        props, headerRow, rows, columnCount, summary = contents
+        text = self.combineElements([ "Table" ] + props) + " :\n"
+        text += self.formatTable(headerRow, rows, max(1, columnCount))
+        return storytext.rowbudget.addSummary(text, summary) if summary else text
 
     def getAllTableItemDescriptions(self, widget, indent=0,
-                                    prefix="", selection=[], columnCount=0, enclosingJfaceTooltip=None):
+                                    prefix="", selection=[], columnCount=0, enclosingJfaceTooltip=None, items=None):
         descs = []
-        for item in widget.getItems():
+        if items is None:
+            items = widget.getItems()
+        for item in items:
             currPrefix = prefix + " " * indent * 2
             selected = item in selection
             if columnCount:
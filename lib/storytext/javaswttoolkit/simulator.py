@@ -1717,6 +1717,9 @@ class WidgetMonitor:
         runOnUIThread(display.addFilter, SWT.Selection, monitorListener)
         
     def widgetShown(self, e):
+        # Paint and selection events happen all the time, new widgets found are reported in monitorAllWidgets
+        if e.type == SWT.Show:
+            self.uiMap.scriptEngine.replayer.notifyUIActivity()
         if self.shouldMonitor(e.widget):
             if isinstance(e.widget, Menu):
                 e.widget.addListener(e.type, EventFinishedListener(e, self.monitorWidgetsFromEvent))
@@ -1778,6 +1781,8 @@ class WidgetMonitor:
             self.widgetsMonitored.update(newWidgets)
         finally:
             self.widgetMonitorLock.release()
+        if newWidgets:
+            self.uiMap.scriptEngine.replayer.notifyUIActivity()
         for widget in self.makeAdapters(newWidgets):
             self.uiMap.monitorWidget(widget)
             self.monitorAsynchronousUpdates(widget)
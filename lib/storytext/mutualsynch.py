@@ -0,0 +1,133 @@
+
+""" Mutual synchronisation of replaying processes over a Unix domain socket.
+The first process to arrive listens on it, the others connect, and all of them are released
+together once everyone has arrived. On Linux the socket lives in the abstract namespace,
+so nothing is left behind if a process dies """
+
+from threading import Thread
+import os, sys, socket, errno, tempfile, time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+def isAvailable():
+    return hasattr(socket, "AF_UNIX")
+
+def getAddress(key, eventName):
+    name = "storytext-" + md5(key + "\0" + eventName.encode("utf-8")).hexdigest()
+    if sys.platform.startswith("linux"):
+        return "\0" + name
+    else:
+        return os.path.join(tempfile.gettempdir(), name)
+
+def startThread(method, *args):
+    thread = Thread(target=method, args=args)
+    thread.setDaemon(True)
+    thread.start()
+
+def closeSocket(sock):
+    try:
+        # Wakes up any thread waiting on it, which closing alone may not do
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    sock.close()
+
+
+class Rendezvous:
+    # How long to keep trying to connect to a socket file with nobody listening, before deciding it was left behind
+    connectRetries = 20
+    connectRetryInterval = 0.05
+    def __init__(self, key, eventName, parties, onComplete):
+        self.address = getAddress(key, eventName)
+        self.eventName = eventName
+        self.parties = parties
+        self.onComplete = onComplete
+        self.socket = None
+        self.isServer = False
+        self.cancelled = False
+
+    def start(self):
+        refusals = 0
+        while refusals <= self.connectRetries:
+            clientSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                clientSocket.connect(self.address)
+                self.socket = clientSocket
+                startThread(self.waitForRelease, clientSocket)
+                return True
+            except socket.error, e:
+                clientSocket.close()
+                if e.args[0] == errno.ECONNREFUSED and not self.address.startswith("\0") and os.path.exists(self.address):
+                    # Someone may have bound it and not be listening yet. If that goes on, they've died
+                    refusals += 1
+                    if refusals <= self.connectRetries:
+                        time.sleep(self.connectRetryInterval)
+                        continue
+                    os.remove(self.address)
+            serverSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                serverSocket.bind(self.address)
+                serverSocket.listen(self.parties)
+                self.socket = serverSocket
+                self.isServer = True
+                startThread(self.serve, serverSocket, self.parties - 1)
+                return True
+            except socket.error:
+                # Probably someone else bound it in between, try to connect again once they're listening
+                serverSocket.close()
+                refusals += 1
+                time.sleep(self.connectRetryInterval)
+        return False
+
+    def cancel(self):
+        # Stop waiting, e.g. when timed out, so a later wait with the same name starts afresh
+        self.cancelled = True
+        if self.socket is not None:
+            closeSocket(self.socket)
+            if self.isServer:
+                self.removeSocketFile()
+
+    def removeSocketFile(self):
+        if not self.address.startswith("\0") and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def serve(self, serverSocket, clientCount):
+        clients = []
+        try:
+            try:
+                while len(clients) < clientCount:
+                    clients.append(serverSocket.accept()[0])
+            except socket.error:
+                if not self.cancelled:
+                    raise
+        finally:
+            # Stop listening before releasing anyone, so a later synch point with the same name starts afresh
+            serverSocket.close()
+            if not self.cancelled:
+                self.removeSocketFile()
+        for client in clients:
+            if not self.cancelled:
+                client.sendall("go")
+            client.close() # if cancelled, the others will time out too
+        if not self.cancelled:
+            self.onComplete(self.eventName)
+
+    def waitForRelease(self, clientSocket):
+        try:
+            try:
+                released = len(clientSocket.recv(2)) > 0
+            except socket.error:
+                released = False
+        finally:
+            clientSocket.close()
+        if released and not self.cancelled: # otherwise the listening process died, leave it to time out
+            self.onComplete(self.eventName)
+
+
+def rendezvous(key, eventName, parties, onComplete):
+    synch = Rendezvous(key, eventName, parties, onComplete)
+    if synch.start():
+        return synch
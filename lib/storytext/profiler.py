@@ -0,0 +1,179 @@
+
+""" Optional timing of replay, written as one JSON object per replayed command.
+Enabled by setting USECASE_REPLAY_PROFILE to the file to write (lines are appended).
+Run this module, or bin/storytext_profile_summary.py, on the files from a test run to see where the time goes """
+
+import os, sys, time, optparse
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError: # e.g. Jython 2.5
+        json = None
+
+def encodeJson(value):
+    if json:
+        return json.dumps(value)
+    elif isinstance(value, dict):
+        return "{" + ", ".join((encodeJson(unicode(k)) + ": " + encodeJson(v) for k, v in value.items())) + "}"
+    elif isinstance(value, basestring):
+        if isinstance(value, str):
+            value = value.decode("utf-8", "replace") # so it can be joined with unicode text
+        text = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t")
+        return '"' + text + '"'
+    elif value is None:
+        return "null"
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    else:
+        return str(value) # repr would give e.g. 123L for longs
+
+
+class ReplayProfiler:
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.record = None
+        # Time spent before the next command starts, e.g. describing the GUI after the previous one
+        self.pendingStages = {}
+        self.pendingTime = 0.0
+        self.waitRecord = None
+
+    def wrap(self, stage, method):
+        def profiledMethod(*args, **kw):
+            startTime = time.time()
+            try:
+                return method(*args, **kw)
+            finally:
+                self.addStageTime(stage, time.time() - startTime)
+        return profiledMethod
+
+    def addStageTime(self, stage, seconds):
+        if self.record:
+            stages = self.record["stages"]
+        else:
+            stages = self.pendingStages
+            self.pendingTime += seconds * 1000
+        stages[stage] = stages.get(stage, 0.0) + seconds * 1000
+
+    def setDetails(self, **kw):
+        if self.record:
+            self.record.update(kw)
+
+    def startCommand(self, command, scriptName):
+        self.endWait()
+        self.record = { "command" : command.strip(), "script" : scriptName, "pid" : os.getpid(), "stages" : self.pendingStages }
+        self.pendingStages = {}
+        self.startTime = time.time() - self.pendingTime / 1000
+        self.pendingTime = 0.0
+
+    def endCommand(self):
+        self.record["total"] = (time.time() - self.startTime) * 1000
+        self.write(self.record)
+        self.record = None
+
+    def startWait(self, command, scriptName):
+        # Whatever happened before the wait belongs to it, not to the command after it
+        self.waitRecord = { "command" : command, "script" : scriptName, "pid" : os.getpid(), "stages" : self.pendingStages }
+        self.pendingStages = {}
+        self.waitStartTime = time.time()
+        self.waitPendingTime = self.pendingTime
+        self.pendingTime = 0.0
+
+    def endWait(self):
+        if self.waitRecord:
+            waitTime = (time.time() - self.waitStartTime) * 1000
+            self.waitRecord["total"] = waitTime + self.waitPendingTime
+            self.waitRecord["stages"]["application event wait"] = waitTime
+            self.write(self.waitRecord)
+            self.waitRecord = None
+
+    def write(self, record):
+        f = open(self.fileName, "a")
+        try:
+            text = encodeJson(record)
+            if isinstance(text, unicode):
+                text = text.encode("utf-8")
+            f.write(text + "\n")
+        finally:
+            f.close()
+
+
+def readRecords(fileNames):
+    records = []
+    for fileName in fileNames:
+        for line in open(fileName):
+            if line.strip():
+                record = json.loads(line)
+                record["file"] = fileName
+                records.append(record)
+    return records
+
+def findFiles(paths, fileName):
+    fileNames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                if fileName in files:
+                    fileNames.append(os.path.join(root, fileName))
+        else:
+            fileNames.append(path)
+    return sorted(fileNames)
+
+def getTotals(records, key):
+    totals = {}
+    for record in records:
+        value = record.get(key)
+        if value is not None:
+            total, count = totals.get(value, (0.0, 0))
+            totals[value] = total + record["total"], count + 1
+    return sorted(totals.items(), key=lambda item: -item[1][0])
+
+def getStageTotals(records):
+    totals = {}
+    for record in records:
+        for stage, stageTime in record["stages"].items():
+            total, count = totals.get(stage, (0.0, 0))
+            totals[stage] = total + stageTime, count + 1
+    return sorted(totals.items(), key=lambda item: -item[1][0])
+
+def writeTotals(title, totals, maxCount):
+    print title
+    for name, (total, count) in totals[:maxCount]:
+        print "%10.1fms %6d %10.1fms  %s" % (total, count, total / count, name)
+    print
+
+def main():
+    parser = optparse.OptionParser("usage: %prog [options] FILE_OR_DIRECTORY ...\n\n" + \
+                                   "Summarise replay profiles written by setting USECASE_REPLAY_PROFILE. " + \
+                                   "Directories are searched for profile files, e.g. a whole TextTest run.")
+    parser.add_option("-f", "--filename", metavar="NAME", default="storytext_profile.json",
+                      help="name of the profile files to look for in directories, default 'storytext_profile.json'")
+    parser.add_option("-n", "--number", metavar="N", type="int", default=20,
+                      help="number of entries to show in each list, default 20")
+    options, args = parser.parse_args()
+    if json is None:
+        sys.stderr.write("Summarising replay profiles needs the json or simplejson module\n")
+        sys.exit(1)
+    records = readRecords(findFiles(args or [ os.getcwd() ], options.filename))
+    if not records:
+        sys.stderr.write("No replay profile records found\n")
+        sys.exit(1)
+
+    columns = "%12s %6s %12s  " % ("total", "count", "mean")
+    totalTime = sum((record["total"] for record in records))
+    print "%d commands replayed in %.1fms\n" % (len(records), totalTime)
+    writeTotals(columns + "Stage", getStageTotals(records), options.number)
+    print "Slowest commands"
+    slowest = sorted(records, key=lambda record: -record["total"])
+    for record in slowest[:options.number]:
+        print "%10.1fms  %s (%s)" % (record["total"], record["command"], record["file"])
+    print
+    writeTotals(columns + "Command", getTotals(records, "command"), options.number)
+    writeTotals(columns + "UI map section", getTotals(records, "section"), options.number)
+    writeTotals(columns + "Widget type", getTotals(records, "widget type"), options.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 
 """ Generic recorder classes. GUI-specific stuff is in guishared.py """
 
-import os, sys, signal, logging
+import os, sys, signal, logging, re, time, codecs, atexit
 from copy import copy
 import replayer, encodingutils, log
+from ingestion import IngestionQueue
 from definitions import *
-from threading import Lock
+from threading import Thread
+from Queue import Queue, Empty
+from itertools import count
 
 try:
     from collections import OrderedDict
@@ -25,11 +28,101 @@ def partitions(set_):
         for b in partitions(parts[1]):
             yield [parts[0]]+b
 
+class RecordFileWriter:
+    """ Encodes and writes recorded lines from a background thread, flushing them in groups
+    rather than after every line. close() returns only when everything is in the file """
+    maxQueueSize = 1000
+    flushLineCount = 50
+    flushInterval = 0.5 # seconds
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.encoder = codecs.lookup(encodingutils.getLocaleEncoding())[0]
+        self.queue = Queue(self.maxQueueSize)
+        self.file = open(fileName, "wb")
+        # Byte offset where each line written so far ends, so lines can be rewritten from any point
+        self.lineEnds = []
+        self.thread = Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, lines, fromIndex=None):
+        self.queue.put((lines, fromIndex))
+
+    def flush(self):
+        self.queue.put(("flush", None))
+        self.queue.join()
+
+    def close(self):
+        if self.thread.isAlive():
+            self.queue.put(("close", None))
+            self.thread.join()
+
+    def run(self):
+        unflushedLines = 0
+        flushTime = None
+        while True:
+            try:
+                if flushTime is None:
+                    lines, fromIndex = self.queue.get()
+                else:
+                    lines, fromIndex = self.queue.get(timeout=max(flushTime - time.time(), 0))
+            except Empty:
+                self.flushFile()
+                unflushedLines = 0
+                flushTime = None
+                continue
+            try:
+                if lines == "close":
+                    self.file.close()
+                    return
+                elif lines != "flush":
+                    self.writeLines(lines, fromIndex)
+                    unflushedLines += len(lines)
+                    if flushTime is None:
+                        flushTime = time.time() + self.flushInterval
+                if lines == "flush" or unflushedLines >= self.flushLineCount:
+                    self.flushFile()
+                    unflushedLines = 0
+                    flushTime = None
+            except (IOError, UnicodeError):
+                self.writeError()
+            finally:
+                self.queue.task_done()
+
+    def flushFile(self):
+        try:
+            self.file.flush()
+        except IOError:
+            self.writeError()
+
+    def writeError(self):
+        type, value, _ = sys.exc_info()
+        sys.stderr.write("ERROR: Unable to record to file " + repr(self.fileName) + " - " + str(value) + "\n")
+
+    def writeLines(self, lines, fromIndex):
+        if fromIndex is not None and fromIndex < len(self.lineEnds):
+            self.file.seek(self.lineEnds[fromIndex - 1] if fromIndex else 0)
+            self.file.truncate()
+            del self.lineEnds[fromIndex:]
+        position = self.lineEnds[-1] if self.lineEnds else 0
+        for line in lines:
+            # File is in binary mode, must use correct line ending explicitly, "\n" will be UNIX line endings on all platforms
+            data = self.encoder(line + os.linesep, "replace")[0]
+            self.file.write(data)
+            position += len(data)
+            self.lineEnds.append(position)
+
+
 # Take care not to record empty files...
 class RecordScript:
+    # Trying every split takes too long with more events than this
+    maxEnumeratedEvents = 8
     def __init__(self, scriptName, shortcuts):
         self.scriptName = scriptName
-        self.fileForAppend = None
+        self.writer = None
+        # What the file contains, or will once the writer catches up
+        self.lines = []
         self.shortcutTrackers = []
         self.initShortcutManager(shortcuts)
         self.registerShortcuts()
@@ -38,6 +131,7 @@ class RecordScript:
         self.shortcutManager = replayer.ShortcutManager()
         for shortcut in shortcuts:
             self.shortcutManager.add(shortcut)
+        self.shortcutAutomaton = ShortcutAutomaton(self.shortcutManager)
 
     def findCompletedTracker(self, line):
         bestTracker = None
@@ -72,6 +166,57 @@ class RecordScript:
             
         return None, None, None
     
+    def findSplitCompleting(self, line):
+        # Only try the splits that some tracker is waiting for, rather than all of them
+        lineEvents = OrderedDict(replayer.parseWaitCommand(line))
+        splits = []
+        for tracker in self.shortcutTrackers:
+            regexp = tracker.getCompletingWaitRegexp()
+            if regexp is None:
+                continue
+            if regexp.groups:
+                # Wait command with arguments, can't tell which events it wants
+                return self.findPartLineCompleting(self.splitLine(line))
+            partEvents = replayer.parseWaitCommand(self.getRegexpText(regexp))
+            otherEvents = self.subtractEvents(lineEvents, partEvents)
+            if otherEvents:
+                partLine = replayer.assembleWaitCommand(partEvents)
+                if partLine not in [ split[0] for split in splits ]:
+                    partTracker = self.findCompletedTracker(partLine)
+                    if partTracker:
+                        splits.append((partLine, partTracker, replayer.assembleWaitCommand(otherEvents)))
+        if len(splits) > 1 and len(lineEvents) <= self.maxEnumeratedEvents:
+            # Several ways to split it: choose between them as if we had tried every split
+            return self.findPartLineCompleting(self.splitLine(line))
+        bestSplit = None, None, None
+        for split in splits:
+            if bestSplit[1] is None or split[1].isLongerThan(bestSplit[1]):
+                bestSplit = split
+        return bestSplit
+
+    @staticmethod
+    def getRegexpText(regexp):
+        # Undo ReplayScript.transformToRegexp for patterns without arguments
+        return re.sub(r"\\(.)", r"\1", regexp.pattern[:-1])
+
+    @staticmethod
+    def subtractEvents(lineEvents, partEvents):
+        partCounts = dict(partEvents)
+        if len(partCounts) != len(partEvents):
+            return
+        dividedEvents = []
+        for event, count in partEvents:
+            lineCount = lineEvents.get(event, 0)
+            if count > lineCount:
+                return
+            elif count < lineCount:
+                dividedEvents.append(event)
+        otherEvents = [ (event, count - partCounts.get(event, 0)) for event, count in lineEvents.items() if count > partCounts.get(event, 0) ]
+        # Same splits as splitLine: a count may only be divided if one side contains nothing else
+        if len(dividedEvents) > 1 or (dividedEvents and len(partEvents) > 1 and len(otherEvents) > 1):
+            return
+        return otherEvents
+
     def isSplittable(self, line):
         return line.startswith(waitCommandName) and ("," in line or "*" in line)
     
@@ -99,8 +244,7 @@ class RecordScript:
         try:
             bestTracker = self.findCompletedTracker(line)
             if bestTracker is None and self.isSplittable(line):
-                eventPairs = self.splitLine(line)
-                partLine, partTracker, otherPartLine = self.findPartLineCompleting(eventPairs)
+                partLine, partTracker, otherPartLine = self.findSplitCompleting(line)
                 if partLine is not None:
                     self.recordWithTracker(partLine, partTracker)
                     self.recordWithTracker(otherPartLine, None)
@@ -111,44 +255,50 @@ class RecordScript:
         except IOError:
             sys.stderr.write("ERROR: Unable to record " + repr(line) + " to file " + repr(self.scriptName) + "\n") 
     
+    def getWriter(self):
+        if not self.writer:
+            self.writer = RecordFileWriter(self.scriptName)
+            self.lines = []
+        return self.writer
+
     def _record(self, line):
-        if not self.fileForAppend:
-            self.fileForAppend = encodingutils.openEncoded(self.scriptName, "w")
-        # File is in binary mode, must use correct line ending explicitly, "\n" will be UNIX line endings on all platforms
-        self.fileForAppend.write(line + os.linesep)
-        self.fileForAppend.flush()
+        self.getWriter().write([ line ])
+        self.lines.append(line)
     
     def registerShortcuts(self):
         for _, shortcut in self.shortcutManager.shortcuts:
-            self.shortcutTrackers.append(ShortcutTracker(shortcut, self.shortcutManager))
+            self.shortcutTrackers.append(ShortcutTracker(shortcut, self.shortcutAutomaton))
 
     def registerShortcut(self, shortcut):
         self.shortcutManager.add(shortcut)
-        self.shortcutTrackers.append(ShortcutTracker(shortcut, self.shortcutManager))
+        self.shortcutAutomaton.invalidate()
+        self.shortcutTrackers.append(ShortcutTracker(shortcut, self.shortcutAutomaton))
     
     def unregisterShortcut(self, shortcut):
-        shortcuts = [s for s in self.shortcutManager.shortcuts]
+        self.shortcutManager.unregister(shortcut)
+        self.shortcutAutomaton.invalidate()
         trackers = [t for t in self.shortcutTrackers]
-        for regexp, script in shortcuts:
-            if script.name == shortcut.name:
-                self.shortcutManager.shortcuts.remove((regexp,script))
-                break
         for tracker in trackers:
             if tracker.replayScript.name == shortcut.name:
                 self.shortcutTrackers.remove(tracker)
                 break
 
+    def flush(self):
+        if self.writer:
+            self.writer.flush()
+
     def close(self):
-        if self.fileForAppend:
-            if not self.fileForAppend.closed:
-                self.fileForAppend.close()
-            self.fileForAppend = None
+        if self.writer:
+            self.writer.close()
+            self.writer = None
 
     def rerecord(self, newCommands):
-        self.close()
-        os.remove(self.scriptName)
-        for command in newCommands:
-            self._record(command)
+        # Only rewrite the file from the first line that has changed
+        unchanged = 0
+        while unchanged < len(self.lines) and unchanged < len(newCommands) and self.lines[unchanged] == newCommands[unchanged]:
+            unchanged += 1
+        self.getWriter().write(newCommands[unchanged:], unchanged)
+        self.lines[unchanged:] = newCommands[unchanged:]
     
     def rename(self, newName):
         self.close()
@@ -156,48 +306,142 @@ class RecordScript:
         self.scriptName = newName
 
 
-class ShortcutTracker:
+class CompiledShortcut:
+    """ The sequence of command patterns expected for one shortcut, with nested shortcuts expanded
+    inline. Each step is worked out the first time a tracker gets that far, and is then shared by
+    all later match attempts, rather than nested scripts being rebuilt on every tracker reset """
     def __init__(self, replayScript, shortcutManager):
-        self.replayScript = replayScript
+        self.replayScript = replayer.ReplayScript(replayScript.name, ignoreComments=True)
+        self.shortcutManager = shortcutManager
         self.currentShortcuts = []
+        self.visitedShortcuts = []
+        self.currentArgs = []
+        # Each step is (regexp, args passed to the current nested shortcut, completes shortcut, length so far)
+        self.steps = []
+
+    def getStep(self, index):
+        while len(self.steps) <= index:
+            regexp = self.getCommandRegexp()
+            completes = self.isCurrentScript() and self.replayScript.hasTerminated()
+            self.steps.append((regexp, self.currentArgs, completes, self.getLength()))
+        return self.steps[index]
+
+    def getCommandRegexp(self):
+        nestedShortcut = self.findNestedShortcut(self.currentShortcuts[-1] if not self.isCurrentScript() else self.replayScript)
+        if nestedShortcut and self.replayScript.name == nestedShortcut.name:
+            return None
+        while  nestedShortcut:
+            newScript = replayer.ReplayScript(nestedShortcut.name, ignoreComments=True)
+            self.visitedShortcuts.append(newScript)
+            self.currentShortcuts.append(newScript)
+            nestedShortcut = self.findNestedShortcut(self.currentShortcuts[-1] if not self.isCurrentScript() else self.replayScript)
+
+        if not self.isCurrentScript():
+            cmdRegexp = self.currentShortcuts[-1].getCommandRegexp()
+            if self.currentShortcuts[-1].hasTerminated():
+                self.currentShortcuts.pop()
+            if cmdRegexp:
+                return cmdRegexp
+            else:
+                return self.getCommandRegexp()
+        return self.replayScript.getCommandRegexp()
+    
+    def findNestedShortcut(self, replayScript):
+        scriptCommand = replayScript.getCommand(matching=self.shortcutManager.getRegexps())
+        if scriptCommand:
+            shortcut, args = self.shortcutManager.findShortcut(scriptCommand)
+            if replayScript == self.replayScript:
+                self.currentArgs = args
+            return shortcut
+    
+    def isCurrentScript(self):
+        return len(self.currentShortcuts) == 0
+
+    def getLength(self):
+        length = 0
+        for shortcut in self.visitedShortcuts:
+            length += len(shortcut.commands)
+        return length + len(self.replayScript.commands) - len(self.visitedShortcuts)
+
+
+class ShortcutAutomaton:
+    """ Compiled form of all shortcuts known to a RecordScript. The trackers are the active
+    partial matches: they share the compiled steps, and each recorded line is matched at most
+    once against each distinct pattern, however many trackers are waiting for it """
+    def __init__(self, shortcutManager):
+        self.shortcutManager = shortcutManager
+        self.compiledShortcuts = {}
+        self.currentLine = None
+        self.matches = {}
+
+    def getCompiled(self, replayScript):
+        compiled = self.compiledShortcuts.get(replayScript.name)
+        if compiled is None:
+            compiled = CompiledShortcut(replayScript, self.shortcutManager)
+            self.compiledShortcuts[replayScript.name] = compiled
+        return compiled
+
+    def invalidate(self):
+        # Nesting depends on which shortcuts exist, so recompile when that changes
+        self.compiledShortcuts = {}
+
+    def match(self, regexp, line):
+        if line != self.currentLine:
+            self.currentLine = line
+            self.matches = {}
+        if regexp.pattern not in self.matches:
+            self.matches[regexp.pattern] = regexp.match(line)
+        return self.matches[regexp.pattern]
+
+
+class ShortcutTracker:
+    def __init__(self, replayScript, automaton):
+        self.replayScript = replayScript
+        self.automaton = automaton
         self.commandsForMatch = []
         self.commandsForMismatch = []
-        self.visitedShortcuts = []
         self.logger = log.getLogger("Shortcut Tracker")
-        self.shortcutManager = shortcutManager
         self.reset()
 
     def reset(self):
-        self.replayScript = replayer.ReplayScript(self.replayScript.name, ignoreComments=True)
-        self.currentShortcuts = []
+        self.compiledShortcut = self.automaton.getCompiled(self.replayScript)
+        self.stepIndex = 0
         self.commandsForMatch = copy(self.commandsForMismatch)
         self.argsUsed = []
-        self.currentArgs = []
-        self.visitedShortcuts = []
-        self.currRegexp = self.getCommandRegexp()
+        self.currRegexp, self.currentArgs, self.completes, _ = self.compiledShortcut.getStep(0)
+
+    def advance(self):
+        self.stepIndex += 1
+        self.currRegexp, self.currentArgs, self.completes, _ = self.compiledShortcut.getStep(self.stepIndex)
 
     def hasStarted(self):
         return self.commandsForMismatch != self.commandsForMatch
 
+    def getCompletingWaitRegexp(self):
+        if self.currRegexp is not None and self.completes and self.currRegexp.pattern.startswith(waitCommandName):
+            return self.currRegexp
+
     def updateCompletes(self, line):
         if self.currRegexp is None:
             return False # We already reached the end and should forever be ignored...
-        match = self.currRegexp.match(line)
-        self.logger.debug("Update completes? " +  self.replayScript.getShortcutName() + ", " + self.currRegexp.pattern \
-                          + ", " +  repr(line) + ", " + repr(self.commandsForMismatch) + ", " + repr(self.commandsForMatch))
-        return match and self.isCurrentScript() and self.replayScript.hasTerminated()
+        match = self.automaton.match(self.currRegexp, line)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Update completes? %s, %s, %r, %r, %r", self.replayScript.getShortcutName(), self.currRegexp.pattern,
+                              line, self.commandsForMismatch, self.commandsForMatch)
+        return match and self.completes
     
     def addCommand(self, line):
         if self.currRegexp is None:
-            self.logger.debug("Ignore " +  self.replayScript.getShortcutName())  # We already reached the end and should forever be ignored...
+            self.logger.debug("Ignore %s", self.replayScript.getShortcutName())  # We already reached the end and should forever be ignored...
             return
-        match = self.currRegexp.match(line)
+        match = self.automaton.match(self.currRegexp, line)
         if match:
             self.commandsForMismatch.append(line)
-            self.logger.debug("Match " +  self.replayScript.getShortcutName() + ", " + self.currRegexp.pattern \
-                               + ", " +  repr(line) + ", " + repr(self.commandsForMismatch) + ", " + repr(self.commandsForMatch))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Match %s, %s, %r, %r, %r", self.replayScript.getShortcutName(), self.currRegexp.pattern,
+                                  line, self.commandsForMismatch, self.commandsForMatch)
             positions = self.getPositions(self.currentArgs)
-            self.currRegexp = self.getCommandRegexp()
+            self.advance()
             groupdict = match.groupdict()
             if groupdict: # numbered arguments
                 for key, val in groupdict.items():
@@ -217,7 +461,7 @@ class ShortcutTracker:
         else:
             if self.hasStarted():
                 self.reset()
-                self.logger.debug("Reset " + self.replayScript.getShortcutName() + ", " + repr(self.commandsForMismatch))
+                self.logger.debug("Reset %s, %r", self.replayScript.getShortcutName(), self.commandsForMismatch)
                 self.addCommand(line)
             else:
                 self.commandsForMismatch.append(line)
@@ -262,7 +506,7 @@ class ShortcutTracker:
             self.reset()
         elif not started:
             self.commandsForMatch = copy(self.commandsForMismatch)
-        self.logger.debug("Rerecord " + self.replayScript.getShortcutName() + ", " + repr(self.commandsForMismatch) + ", " + repr(self.commandsForMatch))
+        self.logger.debug("Rerecord %s, %r, %r", self.replayScript.getShortcutName(), self.commandsForMismatch, self.commandsForMatch)
         
     def getNewCommands(self):
         shortcutName = self.replayScript.getShortcutNameWithArgs(self.argsUsed)
@@ -274,42 +518,79 @@ class ShortcutTracker:
     def isLongerThan(self, otherTracker):
         return self.getLength() > otherTracker.getLength()
 
-    def getCommandRegexp(self):
-        nestedShortcut = self.findNestedShortcut(self.currentShortcuts[-1] if not self.isCurrentScript() else self.replayScript)
-        if nestedShortcut and self.replayScript.name == nestedShortcut.name:
-            return None
-        while  nestedShortcut:
-            newScript = replayer.ReplayScript(nestedShortcut.name, ignoreComments=True)
-            self.visitedShortcuts.append(newScript)
-            self.currentShortcuts.append(newScript)
-            nestedShortcut = self.findNestedShortcut(self.currentShortcuts[-1] if not self.isCurrentScript() else self.replayScript)
+    def getLength(self):
+        return self.compiledShortcut.getStep(self.stepIndex)[3]
 
-        if not self.isCurrentScript():
-            cmdRegexp = self.currentShortcuts[-1].getCommandRegexp()
-            if self.currentShortcuts[-1].hasTerminated():
-                self.currentShortcuts.pop()
-            if cmdRegexp:
-                return cmdRegexp
-            else:
-                return self.getCommandRegexp()
-        return self.replayScript.getCommandRegexp()
-    
-    def findNestedShortcut(self, replayScript):
-        scriptCommand = replayScript.getCommand(matching=self.shortcutManager.getRegexps())
-        if scriptCommand:
-            shortcut, args = self.shortcutManager.findShortcut(scriptCommand)
-            if replayScript == self.replayScript:
-                self.currentArgs = args
-            return shortcut
-    
-    def isCurrentScript(self):
-        return len(self.currentShortcuts) == 0
 
-    def getLength(self):
-        length = 0
-        for shortcut in self.visitedShortcuts:
-            length += len(shortcut.commands)
-        return length + len(self.replayScript.commands) - len(self.visitedShortcuts)
+class ApplicationEventStore:
+    """ Application events keyed by (category, delay level), kept in the order they arrived.
+    Also indexed by event name and by delay level, so finding those doesn't mean going through all of them """
+    def __init__(self):
+        self.events = OrderedDict()
+        self.positions = {}
+        self.counter = count()
+        self.keysByName = {}
+        self.keysByDelayLevel = {}
+
+    def __contains__(self, key):
+        return key in self.events
+
+    def __len__(self):
+        return len(self.events)
+
+    def __getitem__(self, key):
+        return self.events[key]
+
+    def __repr__(self):
+        return repr(self.events)
+
+    def get(self, key, default=None):
+        return self.events.get(key, default)
+
+    def items(self):
+        return self.events.items()
+
+    def __setitem__(self, key, eventName):
+        if key in self.events:
+            # Keeps its position, as with a dictionary
+            self.removeFromIndex(self.keysByName, self.events[key], key)
+        else:
+            self.positions[key] = self.counter.next()
+            self.keysByDelayLevel.setdefault(key[1], set()).add(key)
+        self.events[key] = eventName
+        self.keysByName.setdefault(eventName, set()).add(key)
+
+    def __delitem__(self, key):
+        eventName = self.events.pop(key)
+        del self.positions[key]
+        self.removeFromIndex(self.keysByName, eventName, key)
+        self.removeFromIndex(self.keysByDelayLevel, key[1], key)
+
+    def removeFromIndex(self, index, indexKey, key):
+        keys = index[indexKey]
+        keys.remove(key)
+        if not keys:
+            del index[indexKey]
+
+    def update(self, other):
+        for key, eventName in other.items():
+            self[key] = eventName
+
+    def getItemsInOrder(self, keys):
+        return [ (key, self.events[key]) for key in sorted(keys, key=self.positions.get) ]
+
+    def itemsWithName(self, eventName):
+        return self.getItemsInOrder(self.keysByName.get(eventName, []))
+
+    def itemsFromDelayLevel(self, minDelayLevel):
+        levels = [ level for level in self.keysByDelayLevel.keys() if level >= minDelayLevel ]
+        if len(levels) == len(self.keysByDelayLevel):
+            return self.events.items()
+        keys = []
+        for level in levels:
+            keys.extend(self.keysByDelayLevel[level])
+        return self.getItemsInOrder(keys)
+
 
 class UseCaseRecorder:
     def __init__(self, shortcuts):
@@ -319,7 +600,7 @@ class UseCaseRecorder:
         self.scripts = []
         self.comments = []
         self.processId = os.getpid()
-        self.applicationEvents = OrderedDict()
+        self.applicationEvents = ApplicationEventStore()
         self.supercededAppEventCategories = {}
         self.suspended = 0
         self.realSignalHandlers = {}
@@ -327,7 +608,7 @@ class UseCaseRecorder:
         self.signalNames = {}
         self.stateChangeEventInfo = {}
         self.delayedEvents = []
-        self.applicationEventLock = Lock()
+        self.applicationEventQueue = IngestionQueue("application events")
         self.hasAutoRecordings = False
         recordScript = os.getenv("USECASE_RECORD_SCRIPT")
         if recordScript:
@@ -347,7 +628,7 @@ class UseCaseRecorder:
         return len(self.scripts) > 0
 
     def storeComment(self, comment):
-        self.logger.debug("Storing comment " + repr(comment))
+        self.logger.debug("Storing comment %r", comment)
         self.comments.append(comment)
 
     def addScript(self, scriptName, shortcuts=[]):
@@ -361,6 +642,10 @@ class UseCaseRecorder:
                 self.recordComments()
         for script in self.scripts:
             script.close()
+
+    def flushScripts(self):
+        for script in self.scripts:
+            script.flush()
     
     def addSignalHandlers(self):
         signal.signal = self.appRegistersSignal
@@ -388,14 +673,20 @@ class UseCaseRecorder:
 
     def terminateScript(self):
         script = self.scripts.pop()
-        if script.fileForAppend:
+        if script.writer:
             return script
 
     def recordSignal(self, signum, stackFrame):
-        self.writeApplicationEventDetails(self.applicationEvents, minDelayLevel=0) # no means of delaying received signals
-        self.record(signalCommandName + " " + self.signalNames[signum])
-        self.processDelayedEvents(self.delayedEvents)
-        self.delayedEvents = []
+        self.applicationEventQueue.acquire()
+        try:
+            self.writeApplicationEventDetails(self.applicationEvents, minDelayLevel=0) # no means of delaying received signals
+            self.record(signalCommandName + " " + self.signalNames[signum])
+            self.processDelayedEvents(self.delayedEvents)
+            self.delayedEvents = []
+        finally:
+            self.applicationEventQueue.release()
+        # The signal may well terminate us, make sure everything is written first
+        self.flushScripts()
         # Reset the handler and send the signal to ourselves again...
         realHandler = self.realSignalHandlers[signum]
         # If there was no handler-override installed, resend the signal with the handler reset
@@ -420,10 +711,14 @@ class UseCaseRecorder:
         if len(self.scripts) == 0 or self.suspended == 1:
             self.logger.debug("Received event, but recording is disabled or suspended")
             return
+        # Application events registered by other threads are stored and read under the lock
+        self.applicationEventQueue.call(self._writeEvent, *args)
+
+    def _writeEvent(self, *args):
         event = self.findEvent(*args)
-        self.logger.debug("Event of type " + event.__class__.__name__ + " for recording")
+        self.logger.debug("Event of type %s for recording", event.__class__.__name__)
         if not event.shouldRecord(*args):
-            self.logger.debug("Told we should not record it : args were " + repr(args))
+            self.logger.debug("Told we should not record it : args were %r", args)
             if event.checkPreviousWhenRejected():
                 delayLevel = event.delayLevel(*args)
                 if delayLevel in self.stateChangeEventInfo:
@@ -448,8 +743,8 @@ class UseCaseRecorder:
 
         scriptOutput = event.outputForScript(*args)
         if event.isStateChange() and delayLevel >= self.getMaximumStoredDelay():
-            appEvents = {} if impliesPrevious else self.transferAppEvents(delayLevel)                
-            self.logger.debug("Storing up state change event " + repr(scriptOutput) + " with delay level " + repr(delayLevel) + " and app events " + repr(appEvents))
+            appEvents = ApplicationEventStore() if impliesPrevious else self.transferAppEvents(delayLevel)                
+            self.logger.debug("Storing up state change event %r with delay level %r and app events %r", scriptOutput, delayLevel, appEvents)
             self.stateChangeEventInfo[delayLevel] = scriptOutput, event, appEvents
         else:
             # If impliesPrevious is true, it means any app events since the last state change event were essentially generated by the current event
@@ -461,11 +756,8 @@ class UseCaseRecorder:
                 self.delayedEvents = []
 
     def transferAppEvents(self, delayLevel):
-        appEvents = OrderedDict()
-        for appEventKey, eventName in self.applicationEvents.items():
-            _, currDelayLevel = appEventKey
-            if currDelayLevel < delayLevel:
-                continue
+        appEvents = ApplicationEventStore()
+        for appEventKey, eventName in self.applicationEvents.itemsFromDelayLevel(delayLevel):
             appEvents[appEventKey] = eventName
             del self.applicationEvents[appEventKey]
         return appEvents
@@ -475,7 +767,7 @@ class UseCaseRecorder:
 
     def recordOrDelay(self, scriptOutput, delayLevel, source):
         if delayLevel:
-            self.logger.debug("Delaying event " + repr(scriptOutput) + " at level " + repr(delayLevel))
+            self.logger.debug("Delaying event %r at level %r", scriptOutput, delayLevel)
             self.delayedEvents.append((scriptOutput, delayLevel, source))
             return False
         else:
@@ -489,8 +781,10 @@ class UseCaseRecorder:
         newDelayLevel = level - 1
         # Must reset this, or we can't register new events without them colliding with our stored ones...
         self.delayedEvents = []
+        self.applicationEventQueue.acquire()
         for eventName, category in source:
-            self.registerApplicationEvent(eventName, category, delayLevel=newDelayLevel)
+            self._registerApplicationEvent(eventName, category, delayLevel=newDelayLevel)
+        self.applicationEventQueue.release()
         
         self.logger.debug("Done restoring delayed application events.")
         
@@ -529,7 +823,7 @@ class UseCaseRecorder:
         self._record(line, event)
         
     def _record(self, line, event=None):
-        self.logger.debug("Recording " + repr(line))
+        self.logger.debug("Recording %r", line)
         self.hasAutoRecordings |= line.startswith("Auto.")
         for script in self.getScriptsToRecord(event):
             script.record(line)
@@ -546,9 +840,8 @@ class UseCaseRecorder:
                 return arg
          
     def registerApplicationEvent(self, *args, **kw):
-        self.applicationEventLock.acquire()
-        self._registerApplicationEvent(*args, **kw)
-        self.applicationEventLock.release()
+        # Recording an event takes the lock, so anything handed over is stored before it's read
+        self.applicationEventQueue.submit(self._registerApplicationEvent, *args, **kw)
        
     def _registerApplicationEvent(self, eventName, category, supercedeCategories=[], delayLevel=0):
         category = category or "storytext_DEFAULT"
@@ -576,7 +869,7 @@ class UseCaseRecorder:
                 self.supercededAppEventCategories.setdefault(supercedeCategory, set()).add(category)
 
     def applicationEventRename(self, oldName, newName, oldCategory, newCategory):
-        self.applicationEventLock.acquire()
+        self.applicationEventQueue.acquire()
         for appEventKey, oldEventName in self.applicationEvents.items():
             categoryName, delayLevel = appEventKey
             if oldCategory in categoryName:
@@ -589,17 +882,17 @@ class UseCaseRecorder:
                 categories.remove(oldCategory)
                 categories.add(newCategory)
                 self.logger.debug("Swapping for " + repr(supercedeCategory) + ": " + repr(oldCategory) + " -> " + repr(newCategory))
-        self.applicationEventLock.release()
+        self.applicationEventQueue.release()
 
     def applicationEventDelay(self, name, fromLevel=0, increase=True):
-        self.applicationEventLock.acquire()
-        for appEventKey, eventName in self.applicationEvents.items():
+        self.applicationEventQueue.acquire()
+        for appEventKey, eventName in self.applicationEvents.itemsWithName(name):
             categoryName, oldDelayLevel = appEventKey
-            if eventName == name and oldDelayLevel == fromLevel:
+            if oldDelayLevel == fromLevel:
                 del self.applicationEvents[appEventKey]
                 newDelayLevel = oldDelayLevel + 1 if increase else oldDelayLevel - 1
                 self._registerApplicationEvent(name, categoryName, delayLevel=newDelayLevel)
-        self.applicationEventLock.release()
+        self.applicationEventQueue.release()
                 
     def makeMultiple(self, text, count):
         if count == 1:
@@ -613,12 +906,9 @@ class UseCaseRecorder:
         self.applicationEvents[categoryName, delayLevel] = newEventName
 
     def getCurrentApplicationEvents(self, events, minDelayLevel):
-        allEvents = events.items()
         appEventInfo = {}
-        for appEventKey, eventName in allEvents:
+        for appEventKey, eventName in events.itemsFromDelayLevel(minDelayLevel):
             categoryName, currDelayLevel = appEventKey
-            if currDelayLevel < minDelayLevel:
-                continue
             appEventInfo.setdefault(currDelayLevel, []).append((eventName, categoryName))
             del events[appEventKey]
         return appEventInfo
@@ -639,7 +929,7 @@ class UseCaseRecorder:
             script.unregisterShortcut(replayScript)
             
     def unregisterApplicationEvent(self, matchFunction):
-        self.applicationEventLock.acquire()
+        self.applicationEventQueue.acquire()
         for appEventKey, eventName in self.applicationEvents.items():
             categoryName, delayLevel = appEventKey
             if matchFunction(eventName, delayLevel):
@@ -649,8 +939,8 @@ class UseCaseRecorder:
                     del self.applicationEvents[appEventKey]
                 else:
                     self.reduceApplicationEventCount(basicName, categoryName, delayLevel, count - 1)
-                self.applicationEventLock.release()
+                self.applicationEventQueue.release()
                 return True
-        self.applicationEventLock.release()
+        self.applicationEventQueue.release()
         return False
     
@@ -1,12 +1,15 @@
 
 """ Generic recorder classes. GUI-specific stuff is in guishared.py """
 
-import os, sys, signal, time, re
+import os, sys, signal, time, re, heapq
 from filepolling import poll_file
-import encodingutils
-from threading import Thread, Timer, Lock
+from profiler import ReplayProfiler
+import encodingutils, mutualsynch
+from threading import Thread, Lock, Condition
+from itertools import count
 from definitions import *
 from copy import copy
+from traceback import format_exception
 
 try:
     from collections import OrderedDict
@@ -22,6 +25,13 @@ def parseMultiples(text):
     else:
         return text, 1
         
+mutualSynchPartiesRegexp = re.compile(r" \((\d+) processes\)$")
+
+def parseMutualSynchParties(eventName):
+    # 'other usecase <name> (N processes)' synchronises N processes in all, by default 2
+    match = mutualSynchPartiesRegexp.search(parseMultiples(eventName)[0])
+    return int(match.group(1)) if match else 2
+
 def parseWaitCommand(line):
     return map(parseMultiples, line[len(waitCommandName) + 1:].split(", "))
 
@@ -32,23 +42,99 @@ def assembleWaitCommand(parsedEvents):
         events.append(baseEvent + postfix)
     return waitCommandName + " " + ", ".join(sorted(events))
 
+class CompiledLine:
+    """ What replaying needs to know about a script line, worked out once rather than each time it is replayed:
+    whether it is a comment or a wait command, and where its $ arguments are substituted """
+    argRegexp = re.compile("\$[0-9]*")
+    def __init__(self, command):
+        self.isComment = ReplayScript.isComment(command)
+        self.isWait = waitRegexp.match(command) is not None
+        # One argument is substituted per word containing a $
+        argCount = len([ n for n in command.split() if "$" in n ])
+        self.parts = []
+        self.argIndices = []
+        self.regular = True
+        pos = 0
+        for match in list(self.argRegexp.finditer(command))[:argCount]:
+            self.parts.append(command[pos:match.start()])
+            self.argIndices.append(self.getArgIndex(command, match.start() + 1))
+            pos = match.end()
+        self.parts.append(command[pos:])
+
+    def getArgIndex(self, command, pos):
+        if pos < len(command) and command[pos].isdigit():
+            if command[pos] in "0123456789":
+                return int(command[pos]) - 1
+            else:
+                self.regular = False
+
+    def canSubstitute(self, args):
+        # Arguments containing these would be treated specially when substituted one at a time with re.sub
+        return self.regular and not any(("$" in arg or "\\" in arg for arg in args))
+
+    def substitute(self, args):
+        text = self.parts[0]
+        for argIndex, part in zip(self.argIndices, self.parts[1:]):
+            if argIndex is not None and argIndex < len(args):
+                text += args[argIndex] + part
+            else:
+                currArg = args.pop(0)
+                args.append(currArg) # cycle through them...
+                text += currArg + part
+        return text
+
+
+class ParsedScriptCache:
+    """ Stores the commands read from each script file for the whole process, so shortcut files
+    are not re-read every time a ReplayScript is created for them. An entry is only reused if
+    the file's modification time and size are unchanged. Each distinct line is also compiled once """
+    def __init__(self):
+        self.entries = {}
+        self.compiledLines = {}
+
+    def getCompiledLine(self, command):
+        compiledLine = self.compiledLines.get(command)
+        if compiledLine is None:
+            compiledLine = self.compiledLines[command] = CompiledLine(command)
+        return compiledLine
+
+    def getCommands(self, fileName, ignoreComments):
+        key = os.path.abspath(fileName), ignoreComments
+        statInfo = os.stat(fileName)
+        fileInfo = statInfo.st_mtime, statInfo.st_size
+        cached = self.entries.get(key)
+        if cached and cached[0] == fileInfo:
+            return cached[1]
+        # Tuples, as they are shared by all scripts reading the same file
+        commands = tuple(self.readCommands(fileName, ignoreComments))
+        self.entries[key] = fileInfo, commands
+        return commands
+
+    def readCommands(self, fileName, ignoreComments):
+        commands = []
+        for line in encodingutils.openEncoded(fileName):
+            line = line.strip("\r\n")
+            if not ignoreComments or (line != "" and line[0] != "#"):
+                commands.append(line)
+        return commands
+
+parsedScriptCache = ParsedScriptCache()
+
+
 class ReplayScript(object):
     def __init__(self, scriptName, ignoreComments=False):
-        self.commands = []
         self.exitObservers = []
         self.pointer = 0
         self.name = scriptName
         if not os.path.isfile(scriptName):
             raise UseCaseScriptError, "Cannot replay script " + repr(scriptName) + ", no such file or directory."
-        for line in encodingutils.openEncoded(scriptName):
-            line = line.strip("\r\n")
-            if not ignoreComments or (line != "" and line[0] != "#"):
-                self.commands.append(line)
+        self.commands = parsedScriptCache.getCommands(scriptName, ignoreComments)
                 
     def __copy__(self):
         obj_copy = object.__new__(type(self))
         obj_copy.__dict__ = self.__dict__.copy()
-        obj_copy.commands = copy(self.commands)
+        # Copies may be extended (see addWaitCommand), so they get their own list
+        obj_copy.commands = list(self.commands)
         return obj_copy
 
     def addExitObserver(self, observer):
@@ -116,6 +202,13 @@ class ReplayScript(object):
                 self.pointer += 1
                 return self.replaceArgs(nextCommand, args)
 
+    def getWaitCommand(self, args):
+        if not self.hasTerminated():
+            nextCommand = self.commands[self.pointer]
+            if parsedScriptCache.getCompiledLine(nextCommand).isWait:
+                self.pointer += 1
+                return self.replaceArgs(nextCommand, args)
+
     def getArgument(self, nextCommand, args):
         pos = nextCommand.find("$")
         if pos + 1 < len(nextCommand):
@@ -129,6 +222,13 @@ class ReplayScript(object):
         return currArg
 
     def replaceArgs(self, nextCommand, args):
+        if args:
+            compiledLine = parsedScriptCache.getCompiledLine(nextCommand)
+            if compiledLine.canSubstitute(args):
+                return compiledLine.substitute(args)
+        return self.replaceArgsWithRegexp(nextCommand, args)
+
+    def replaceArgsWithRegexp(self, nextCommand, args):
         origCommand = nextCommand
         if args:
             for n in origCommand.split():
@@ -150,7 +250,7 @@ class ReplayScript(object):
         comments = []
         while self.pointer < len(self.commands):
             nextCommand = self.commands[self.pointer]
-            if self.isComment(nextCommand):
+            if parsedScriptCache.getCompiledLine(nextCommand).isComment:
                 comments.append(nextCommand)
                 self.pointer += 1
             else:
@@ -168,7 +268,7 @@ class ReplayScript(object):
         commentsAfter = self.extractAllComments()
 
         # Process application events together with the previous command so the log comes out sensibly...
-        waitCommand = self.getCommand(args, [ waitRegexp ])
+        waitCommand = self.getWaitCommand(args)
         if waitCommand:
             commands += commentsAfter
             commands.append(waitCommand)
@@ -195,12 +295,89 @@ class ReplayScript(object):
         self.name = newPath
         
         
+class CommandNameIndex:
+    """ Character trie over the registered event names, so that finding the longest
+    event name a command starts with costs time proportional to the command length """
+    def __init__(self):
+        self.root = {}
+
+    def add(self, name):
+        node = self.root
+        for char in name:
+            node = node.setdefault(char, {})
+        node[None] = name
+
+    def findLongestPrefix(self, text):
+        longest = ""
+        node = self.root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            longest = node.get(None, longest)
+        return longest
+
+    def findAllPrefixes(self, text):
+        prefixes = [ self.root[None] ] if None in self.root else []
+        node = self.root
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                prefixes.append(node[None])
+        return prefixes
+
+
+class ShortcutMatcher:
+    """ Groups shortcuts by the literal text before their first argument, and also notes
+    the literal text after their last one. Only shortcuts whose literal ends fit the command
+    need their regular expressions trying """
+    nonLiteralRegexp = re.compile("\\$[0-9]*|[.\\\\]")
+    def __init__(self, shortcuts):
+        self.prefixIndex = CommandNameIndex()
+        self.candidatesByPrefix = {}
+        for index, (regex, shortcut) in enumerate(shortcuts):
+            prefix, suffix = self.getLiteralEnds(shortcut.getShortcutName())
+            if prefix not in self.candidatesByPrefix:
+                self.prefixIndex.add(prefix)
+            self.candidatesByPrefix.setdefault(prefix, []).append((index, suffix, regex, shortcut))
+
+    @classmethod
+    def getLiteralEnds(cls, name):
+        nonLiterals = list(cls.nonLiteralRegexp.finditer(name))
+        if nonLiterals:
+            return name[:nonLiterals[0].start()], name[nonLiterals[-1].end():]
+        else:
+            return name, name
+
+    def findCandidates(self, command):
+        candidates = []
+        for prefix in self.prefixIndex.findAllPrefixes(command):
+            for index, suffix, regex, shortcut in self.candidatesByPrefix[prefix]:
+                if command.endswith(suffix):
+                    candidates.append((index, regex, shortcut))
+        # Keep the registration order, so ties are resolved as they always were
+        candidates.sort()
+        return [ (regex, shortcut) for _, regex, shortcut in candidates ]
+
+
 class ShortcutManager:
     def __init__(self):
         self.shortcuts = []
+        self.matcher = None
+        self.resolved = {}
         
     def add(self, shortcut):
         self.shortcuts.append((shortcut.getShortcutRegexp(), shortcut))
+        self.matcher = None
+
+    def getMatcher(self):
+        # Built lazily, as shortcuts are often added or removed several at a time
+        if self.matcher is None:
+            self.matcher = ShortcutMatcher(self.shortcuts)
+            self.resolved = {}
+        return self.matcher
 
     def getShortcuts(self):
         # Drop the trailing $ from the pattern
@@ -210,14 +387,23 @@ class ShortcutManager:
         return [ r for r, _ in self.shortcuts ]
     
     def findShortcut(self, command):
+        # Each command is resolved once for a given set of shortcuts.
+        # Callers get their own copy of the arguments, as replaying cycles through them
+        matcher = self.getMatcher()
+        resolved = self.resolved.get(command)
+        if resolved is None:
+            resolved = self.resolved[command] = self.resolveShortcut(matcher, command)
+        return resolved[0], list(resolved[1])
+
+    def resolveShortcut(self, matcher, command):
         bestShortcut, bestArgs = None, []
-        for regex, shortcut in self.shortcuts:
+        for regex, shortcut in matcher.findCandidates(command):
             match = regex.match(command)
             if match:
                 args = list(match.groups())
                 if bestShortcut is None or self.isBetterShortcut(args, bestArgs):
                     bestShortcut, bestArgs = shortcut, args
-        return bestShortcut, bestArgs
+        return bestShortcut, tuple(bestArgs)
 
     def isBetterShortcut(self, args1, args2):
         if len(args1) != len(args2):
@@ -230,15 +416,108 @@ class ShortcutManager:
         return argLength1 < argLength2
     
     def remove(self, shortcut):
-        self.shortcuts.remove((shortcut.getShortcutRegexp(), shortcut))
+        self.unregister(shortcut)
         os.remove(shortcut.name)
+
+    def unregister(self, shortcut):
+        for regex, script in self.shortcuts:
+            if script.name == shortcut.name:
+                self.shortcuts.remove((regex, script))
+                self.matcher = None
+                return
         
     def rename(self, oldName, newName):
         shortcut = self.findShortcut(oldName)[0]
-        self.shortcuts.remove((shortcut.getShortcutRegexp(), shortcut))
+        self.unregister(shortcut)
         shortcut.rename(newName)
         self.add(shortcut)
     
+
+
+class TimerScheduler:
+    """ Calls methods after a delay from a single thread, instead of a thread per timer.
+    The thread only runs while something is scheduled, so pending timers keep the process alive as threading.Timer would """
+    def __init__(self):
+        self.condition = Condition()
+        self.entries = []
+        self.counter = count()
+        self.thread = None
+
+    def schedule(self, delay, method, *args):
+        self.condition.acquire()
+        # The counter keeps entries with equal deadlines in order and means we never compare methods
+        entry = [ time.time() + delay, self.counter.next(), method, args ]
+        heapq.heappush(self.entries, entry)
+        if self.thread is None:
+            self.thread = Thread(target=self.run)
+            self.thread.start()
+        else:
+            self.condition.notify()
+        self.condition.release()
+        return entry
+
+    def cancel(self, entry):
+        self.condition.acquire()
+        if entry in self.entries:
+            self.entries.remove(entry)
+            heapq.heapify(self.entries)
+            self.condition.notify()
+        self.condition.release()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while self.entries:
+                timeLeft = self.entries[0][0] - time.time()
+                if timeLeft > 0:
+                    self.condition.wait(timeLeft)
+                else:
+                    _, _, method, args = heapq.heappop(self.entries)
+                    self.condition.release()
+                    try:
+                        method(*args)
+                    except:
+                        # Don't let one timer stop the others
+                        sys.stderr.write("".join(format_exception(*sys.exc_info())))
+                    self.condition.acquire()
+        finally:
+            self.thread = None
+            self.condition.release()
+
+timerScheduler = TimerScheduler()
+
+
+class SuspendTolerantTimeout:
+    """ Calls a method after the timeout, which is broken up into stages that are each only started
+    when the previous one has finished. The point is to prevent timing out too early if the process gets suspended """
+    stageCount = 5 # whatever
+    def __init__(self, timeout, method):
+        self.stageTimeout = float(timeout) / self.stageCount
+        self.method = method
+        self.stagesLeft = self.stageCount
+        self.cancelled = False
+        self.lock = Lock()
+        self.entry = timerScheduler.schedule(self.stageTimeout, self.stageFinished)
+
+    def stageFinished(self):
+        self.lock.acquire()
+        if self.cancelled:
+            self.lock.release()
+            return
+        self.stagesLeft -= 1
+        if self.stagesLeft:
+            self.entry = timerScheduler.schedule(self.stageTimeout, self.stageFinished)
+            self.lock.release()
+        else:
+            self.lock.release()
+            self.method()
+
+    def cancel(self):
+        self.lock.acquire()
+        self.cancelled = True
+        timerScheduler.cancel(self.entry)
+        self.lock.release()
+
     
 class UseCaseReplayer:
     def __init__(self, recorder, timeout=60):
@@ -246,6 +525,7 @@ class UseCaseReplayer:
         self.scripts = []
         self.shortcutManager = ShortcutManager()
         self.events = {}
+        self.eventNameIndex = CommandNameIndex()
         self.appEventLock = Lock()
         self.waitingForEvents = []
         self.applicationEventNames = set()
@@ -253,7 +533,13 @@ class UseCaseReplayer:
         self.timeDelayNextCommand = 0
         self.eventHappenedMessage = ""
         self.appEventTimer = None
+        self.mutualSynchs = []
         self.appEventTimeout = timeout
+        # Wait for the application to be ready instead of sleeping, where we can tell when it is
+        self.turbo = bool(os.getenv("USECASE_REPLAY_TURBO"))
+        self.timeWaiting = 0.0
+        profileFile = os.getenv("USECASE_REPLAY_PROFILE")
+        self.profiler = self.createProfiler(profileFile) if profileFile else None
         # For things like comments, and hand-added mutual synch events, which cannot be recorded
         # Do not use for other purposes! The recorder should be as independent of the replayer as possible
         self.recorder = recorder
@@ -275,7 +561,13 @@ class UseCaseReplayer:
     
     def addEvent(self, event, eventNames):
         for name in eventNames:
+            if name not in self.events:
+                self.eventNameIndex.add(name)
             self.events.setdefault(name, []).append(event)
+
+    def resetEvents(self):
+        self.events = {}
+        self.eventNameIndex = CommandNameIndex()
     
     def writeRecursiveError(self, script, arguments):
         sys.stderr.write("ERROR: Cannot execute shortcut command '" + script.getShortcutNameWithArgs(arguments) + "' - shortcut is trying to call itself!\n")
@@ -354,6 +646,9 @@ class UseCaseReplayer:
 
     def timeoutApplicationEvents(self):
         self.logger.debug("Waiting aborted after " + str(self.appEventTimeout) + " seconds.")
+        synchs, self.mutualSynchs = self.mutualSynchs, []
+        for synch in synchs:
+            synch.cancel()
         self.notifyWaitingCompleted()
 
     def completedApplicationEvents(self):
@@ -361,6 +656,7 @@ class UseCaseReplayer:
         if self.appEventTimer:
             self.appEventTimer.cancel()
             self.appEventTimer = None
+        self.mutualSynchs = []
         self.notifyWaitingCompleted()
 
     def registerApplicationEvent(self, eventName, timeDelay=0.001, **kw):
@@ -441,10 +737,39 @@ class UseCaseReplayer:
         else:
             return self.addScript(script, arguments, enableReading)
         
+    def waitUntilIdle(self):
+        # Wait until the application has handled everything pending, if we can tell when that is
+        return False
+
+    def waitForApplication(self, delay):
+        startTime = time.time()
+        if self.turbo and self.waitUntilIdle():
+            self.logger.debug("Application is idle, not sleeping for " + repr(delay) + " seconds")
+        else:
+            self.logger.debug("Sleeping for " + repr(delay) + " seconds...")
+            time.sleep(delay)
+        self.timeWaiting += time.time() - startTime
+
+    def createProfiler(self, fileName):
+        # Only wrap the stages when profiling, so it costs nothing otherwise
+        profiler = ReplayProfiler(fileName)
+        self.parseCommand = profiler.wrap("parse", self.parseCommand)
+        self.generateEvent = profiler.wrap("generate", self.generateEvent)
+        self.waitForApplication = profiler.wrap("delay", self.waitForApplication)
+        return profiler
+
+    def getCurrentScriptName(self):
+        if self.scripts:
+            return self.scripts[-1][0].name
+
+    def logCommandTime(self, command, startTime):
+        self.logger.debug("Replaying %r took %.1fms, of which %.1fms was spent waiting",
+                          command, (time.time() - startTime) * 1000, self.timeWaiting * 1000)
+
     def runNextCommand(self, **kw):
+        startTime = time.time()
         if self.timeDelayNextCommand:
-            self.logger.debug("Sleeping for " + repr(self.timeDelayNextCommand) + " seconds...")
-            time.sleep(self.timeDelayNextCommand)
+            self.waitForApplication(self.timeDelayNextCommand)
             self.timeDelayNextCommand = 0
         commands = self.getCommands()
         if len(commands) == 0:
@@ -463,16 +788,31 @@ class UseCaseReplayer:
                 #  Add a delimiter to show that we've replayed something else
                 # Helps the recorder know what order to put things in
                 self.handleComment(None)
-            if command.startswith(waitCommandName):
-                eventName = self.getArgument(command, waitCommandName)
-                if self.processWait(eventName):
-                    self.logger.debug("Event '" + eventName + "' has already happened, no waiting to do")
-                    self.resetWaitingInfo()
+            try:
+                if command.startswith(waitCommandName):
+                    eventName = self.getArgument(command, waitCommandName)
+                    if self.processWait(eventName):
+                        self.logger.debug("Event '" + eventName + "' has already happened, no waiting to do")
+                        self.resetWaitingInfo()
+                    else:
+                        self.logger.debug("Suspending replay waiting for event '" + eventName + "'")
+                        if self.profiler:
+                            self.profiler.startWait(command, self.getCurrentScriptName())
+                        return False, not self.checkTermination()
+                elif self.profiler:
+                    self.profiler.startCommand(command, self.getCurrentScriptName())
+                    try:
+                        self.parseAndProcess(command, **kw)
+                    finally:
+                        self.profiler.endCommand()
+                    self.logCommandTime(command, startTime)
                 else:
-                    self.logger.debug("Suspending replay waiting for event '" + eventName + "'")
-                    return False, not self.checkTermination()
-            else:
-                self.parseAndProcess(command, **kw)
+                    self.parseAndProcess(command, **kw)
+                    self.logCommandTime(command, startTime)
+            finally:
+                # Whatever happened, the waiting so far belongs to this command and not the next one
+                self.timeWaiting = 0.0
+                startTime = time.time()
         return not self.checkTermination(), False
     
     def write(self, line):
@@ -513,12 +853,15 @@ class UseCaseReplayer:
             # The more recently it was added, the more likely it is to work also
             for event in reversed(possibleEvents[1:]):
                 try:
-                    event.generate(argumentString)
+                    self.generateEvent(event, argumentString)
                     return
                 except UseCaseScriptError:
                     type, value, _ = sys.exc_info()
                     self.logger.debug("Error, trying another: " + str(value))  
-            possibleEvents[0].generate(argumentString)
+            self.generateEvent(possibleEvents[0], argumentString)
+
+    def generateEvent(self, event, arguments):
+        event.generate(arguments)
             
     def parseCommand(self, scriptCommand):
         commandName = self.findCommandName(scriptCommand)
@@ -540,27 +883,38 @@ class UseCaseReplayer:
         if command.startswith(signalCommandName):
             return signalCommandName
 
-        longestEventName = ""
-        for eventName in self.events.keys():
-            if command.startswith(eventName) and len(eventName) > len(longestEventName):
-                longestEventName = eventName
-        return longestEventName            
-
-    def startTimer(self, timer):
-        self.appEventTimer = timer
-        self.appEventTimer.start()
+        return self.eventNameIndex.findLongestPrefix(command)
 
     def setAppEventTimer(self):
-        # Break the timer up into 5 sub-timers
-        # The point is to prevent timing out too early if the process gets suspended
-        subTimerCount = 5 # whatever
-        subTimerTimeout = float(self.appEventTimeout) / subTimerCount
-        timer = Timer(subTimerTimeout, self.timeoutApplicationEvents)
-        for _ in range(subTimerCount - 1):
-            timer = Timer(subTimerTimeout, self.startTimer, [ timer ])
-        self.startTimer(timer)
+        self.appEventTimer = SuspendTolerantTimeout(self.appEventTimeout, self.timeoutApplicationEvents)
     
     def handleMutualSynchWait(self, eventName):
+        if self.getMutualSynchProtocol() == "socket":
+            self.handleMutualSynchSocket(eventName)
+        else:
+            self.handleMutualSynchFiles(eventName)
+        self.recorder.registerApplicationEvent(eventName, category="mutual sych")
+
+    def getMutualSynchProtocol(self):
+        # Never chosen automatically: every process synchronising with another has to use the same one
+        return os.getenv("STORYTEXT_MUTUAL_SYNCH", "files")
+
+    def handleMutualSynchSocket(self, eventName):
+        synch = None
+        if mutualsynch.isAvailable():
+            key = os.getenv("STORYTEXT_MUTUAL_SYNCH_KEY") or os.getcwd()
+            synch = mutualsynch.rendezvous(key, eventName, parseMutualSynchParties(eventName), self.registerMutualSynchEvent)
+        if synch:
+            self.mutualSynchs.append(synch)
+            self.logger.debug("Mutual synch initiated for " + repr(eventName))
+        else:
+            sys.stderr.write("ERROR: Could not set up a socket to synchronise with other processes for '" + eventName + "', it will time out.\n")
+
+    def registerMutualSynchEvent(self, eventName):
+        self.logger.debug("Mutual synch completed " + repr(eventName))
+        self.registerApplicationEvent(eventName)
+
+    def handleMutualSynchFiles(self, eventName):
         fileName = eventName.replace(" ", "_")
         if os.path.isfile(fileName):
             os.remove(fileName)
@@ -574,7 +928,6 @@ class UseCaseReplayer:
                 f.close()
             self.logger.debug("Mutual synch initiated for " + repr(eventName))
             poll_file(fileName, eventName, self.registerApplicationEvent)
-        self.recorder.registerApplicationEvent(eventName, category="mutual sych")
     
     def processWait(self, applicationEventStr):
         eventsToWaitFor = applicationEventStr.split(", ")
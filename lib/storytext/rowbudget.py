@@ -0,0 +1,75 @@
+
+""" Limits how many rows of large tables and trees get described.
+The first and last rows are described, along with those currently scrolled into view.
+The others are left out, but a hash of their contents is given so that changes to them still show up """
+
+import os
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+# Set by the --describe-rows option or STORYTEXT_DESCRIBE_ROWS, 0 means no limit
+defaultMaxRows = int(os.getenv("STORYTEXT_DESCRIBE_ROWS", "0"))
+# Set by a DescribeRows entry in a widget's UI map section. Describers call forgetWidget when they drop a widget
+widgetMaxRows = {}
+
+def setWidgetMaxRows(widget, maxRows):
+    widgetMaxRows[widget] = maxRows
+
+def forgetWidget(widget):
+    widgetMaxRows.pop(widget, None)
+
+def getMaxRows(widget):
+    return widgetMaxRows.get(widget, defaultMaxRows)
+
+def isExceeded(maxRows, rowCount):
+    return maxRows > 0 and rowCount > maxRows
+
+def selectRows(maxRows, rowCount, firstVisible, visibleCount):
+    edgeCount = max(1, maxRows // 4)
+    visibleCount = max(0, min(visibleCount, maxRows - 2 * edgeCount))
+    indices = set(range(edgeCount))
+    indices.update(range(max(firstVisible, 0), min(firstVisible + visibleCount, rowCount)))
+    indices.update(range(rowCount - edgeCount, rowCount))
+    return sorted(indices)
+
+def getOmittedIndices(indices, rowCount):
+    described = set(indices)
+    return [ i for i in range(rowCount) if i not in described ]
+
+def insertGaps(rows, indices, gapRow):
+    # rows were described from indices: mark where rows were left out
+    newRows = []
+    prevIndex = -1
+    for index, row in zip(indices, rows):
+        if index != prevIndex + 1:
+            newRows.append(gapRow)
+        newRows.append(row)
+        prevIndex = index
+    return newRows
+
+def getStableText(value):
+    # Other objects may only have a string form that differs from run to run
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    elif isinstance(value, basestring):
+        return value
+    elif isinstance(value, (int, long, float, bool)):
+        return unicode(value)
+    elif value is None:
+        return ""
+    else:
+        return value.__class__.__name__
+
+def getSummary(describedCount, rowCount, omittedTexts):
+    contents = u"\n".join(omittedTexts).encode("utf-8")
+    return "(" + str(describedCount) + " of " + str(rowCount) + " rows described, the others have hash " + \
+           md5(contents).hexdigest()[:8] + ")"
+
+def addSummary(text, summary):
+    if text.endswith("\n"):
+        return text + summary + "\n"
+    else:
+        return text + "\n" + summary
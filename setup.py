@@ -76,6 +76,9 @@ if windows:
             newscripts.append(script + ".exe")
         scripts = newscripts
 
+# Already a Python script, so needs no Windows wrapper
+scripts.append("bin/storytext_profile_summary.py")
+
 packages = [ "storytext" ]
 package_data = {}
 sdist = "sdist" in sys.argv